@@ -1,24 +1,155 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, send_file, url_for
 import os
 import json
 import cv2
 import numpy as np
 import base64
 import io
+import zipfile
 from werkzeug.utils import secure_filename
 import time
-import traceback
+import logging
+import hashlib
+import threading
+import queue
+import uuid
+import re
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # Windows: no cross-process index lock, single server process only.
+    fcntl = None
 
 ### INSIGHTFACE UPDATE ###
 # Import the necessary insightface class. face_recognition is no longer used.
-from insightface.app import FaceAnalysis
+try:
+    from insightface.app import FaceAnalysis
+    from insightface.app.common import Face
+except ImportError: # Only needed to embed photos; the index, search and benchmarks work without it.
+    FaceAnalysis = Face = None
 
 app = Flask(__name__)
+logger = logging.getLogger("snaptrace")
 
 # --- Configuration ---
 EVENT_PHOTOS_DIR = "event_photos"
+# Legacy JSON encodings file. It is migrated into FACE_INDEX_DIR automatically.
 ENCODINGS_FILE = "known_faces_encodings.json"
+# Binary face index: a float32 .npy matrix (opened memory-mapped, so several
+# server processes share one copy through the page cache) plus a JSON manifest.
+FACE_INDEX_DIR = "face_index"
+FACE_INDEX_MANIFEST = os.path.join(FACE_INDEX_DIR, "manifest.json")
+# New uploads are appended as small immutable segments. Once SEGMENT_MERGE_THRESHOLD
+# have accumulated they are merged into one larger segment (cost grows with the
+# pending faces only). The base matrix is rewritten by a background compaction only
+# when pending faces reach COMPACTION_DELTA_FRACTION of it (and at least
+# COMPACTION_MIN_FACES), so rewrites stay rare however large the gallery gets.
+FACE_INDEX_SEGMENTS_DIR = os.path.join(FACE_INDEX_DIR, "segments")
+SEGMENT_MERGE_THRESHOLD = 256
+COMPACTION_DELTA_FRACTION = 0.1
+COMPACTION_MIN_FACES = 10_000
+# Rewritten with every new base matrix and touched on every segment append, so
+# other server processes notice gallery changes by polling one small file.
+FACE_INDEX_VERSION_MARKER = os.path.join(FACE_INDEX_DIR, "version.json")
+INDEX_WATCH_INTERVAL_SECONDS = 2.0
+# Background ingestion: uploads are queued and embedded by a pool of worker
+# processes, each with its own FaceAnalysis model. 0 workers embeds in a single
+# in-process thread using FACE_APP instead.
+INGEST_WORKERS = 2
+INGEST_QUEUE_SIZE = 2000
+MAX_TRACKED_JOBS = 200
+# Job status and paginated result sets are kept as small JSON files, so any server
+# process (e.g. another gunicorn worker) can answer /jobs/<id> and /results/<id>.
+INGEST_JOBS_DIR = os.path.join(FACE_INDEX_DIR, "jobs")
+RESULT_SETS_DIR = os.path.join(FACE_INDEX_DIR, "results")
+# Full rescans (/admin/process_photos) spread photos over this many worker
+# processes and checkpoint every RESCAN_CHECKPOINT_EVERY photos, so an
+# interrupted rescan resumes where it stopped.
+RESCAN_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+RESCAN_CHECKPOINT_EVERY = 50
+RESCAN_CHECKPOINT_DIR = os.path.join(FACE_INDEX_DIR, "rescan")
+# Optional IVF approximate search for very large galleries, used only when
+# LARGE_GALLERY_STRATEGY is "ann" (or clustering is off) and the gallery has at
+# least ANN_MIN_FACES faces. ANN_NLIST=None picks ~4*sqrt(faces) lists; each
+# query scans the ANN_NPROBE closest lists (higher = better recall, slower).
+ANN_ENABLED = True
+ANN_MIN_FACES = 200_000
+ANN_NLIST = None
+ANN_NPROBE = 16
+ANN_TRAIN_SAMPLE = 100_000
+ANN_KMEANS_ITERATIONS = 10
+# Precision of the in-memory searchable copy of the base matrix. "float32" scans
+# the memory-mapped matrix directly. "float16" (2x smaller) and "int8" (4x smaller,
+# per-dimension scalar quantization) scan a compact copy, then re-score only faces
+# within the worst-case quantization error of the threshold against the float32
+# rows on disk. That margin is a strict bound (2^-11 for float16, 0.5*||scale||
+# for int8, typically ~0.02), so matched photos and their scores are identical to
+# the exact path up to float32 rounding (~1e-6). int8 scans about as fast as
+# float32; float16 is slower because numpy widens halves in software.
+INDEX_PRECISION = "float32"
+# Identity clustering: ingest groups faces into per-person clusters (a face joins
+# the closest centroid at >= CLUSTER_ASSIGN_THRESHOLD, otherwise it starts a new
+# cluster). In galleries of CLUSTER_SEARCH_MIN_FACES or more, a query is matched
+# against the centroids first and only the members of clusters at
+# >= CLUSTER_QUERY_THRESHOLD (plus the CLUSTER_QUERY_MIN_CLUSTERS closest) are scored.
+CLUSTERING_ENABLED = True
+CLUSTER_ASSIGN_THRESHOLD = 0.5
+CLUSTER_QUERY_THRESHOLD = 0.3
+CLUSTER_QUERY_MIN_CLUSTERS = 8
+CLUSTER_SEARCH_MIN_FACES = 20_000
+# Candidate strategy "auto" prefers once a gallery is large enough for both. With
+# "clusters" (and clustering enabled) the IVF index is never built; "ann" builds
+# it at ANN_MIN_FACES and uses it there, with cluster search below that size.
+LARGE_GALLERY_STRATEGY = "clusters"
+# Repeated "Find My Photos" presses are served from two LRU/TTL caches: selfie
+# bytes (SHA-1) -> embedding, and (gallery version, embedding rounded to
+# QUERY_CACHE_STEP) -> ranked matches. Any gallery change (reload or upload)
+# bumps GALLERY_VERSION and drops the cached results.
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL_SECONDS = 600
+QUERY_CACHE_STEP = 1 / 512
+# Downscaled copies written at ingest (long side in px) and served to the results
+# grid instead of originals; /download still serves the original file. Missing
+# or stale derivatives are regenerated on first request.
+DERIVATIVES_DIR = os.path.join(EVENT_PHOTOS_DIR, "_derivatives")
+DERIVATIVE_SIZES = {"thumb": 320, "preview": 1280}
+DERIVATIVE_JPEG_QUALITY = 82
+# Photo responses carry ETag/Last-Modified and may be cached this long (seconds).
+PHOTO_CACHE_MAX_AGE = 7 * 24 * 3600
+# Search results are returned in pages; later pages are fetched by result_id.
+RESULTS_PER_PAGE = 60
+MAX_RESULTS_PER_PAGE = 200
+# Bulk downloads stream a ZIP of stored (uncompressed) entries, reading each
+# original in chunks of this many bytes.
+ZIP_STREAM_CHUNK_SIZE = 1 << 20
+# Selfie decoding and face analysis run on a bounded thread pool per server
+# process; requests beyond INFERENCE_THREADS running + INFERENCE_QUEUE_SIZE
+# waiting are turned away with 503 instead of piling up on the request threads.
+INFERENCE_THREADS = 2
+INFERENCE_QUEUE_SIZE = 8
+INFERENCE_TIMEOUT_SECONDS = 30
+# Largest selfie accepted by /find_my_photos (raw, multipart or JSON upload).
+MAX_SELFIE_BYTES = 8 * 1024 * 1024
+# Logging level for the "snaptrace" logger (DEBUG adds per-photo and per-request
+# lines; WARNING keeps the hot paths silent).
+LOG_LEVEL = os.environ.get("SNAPTRACE_LOG_LEVEL", "INFO").upper()
+# Per-stage latency histograms for /metrics. p50/p99 are computed over the last
+# METRICS_RECENT_SAMPLES observations of each stage.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_RECENT_SAMPLES = 1024
+# Each server process publishes its metrics to METRICS_DIR/<pid>.json from the
+# index watcher, and /metrics adds up every process, so totals do not depend on
+# which gunicorn worker answers a scrape. Metrics of exited workers are folded
+# into retired.json, keeping counters monotonic; delete the directory to reset them.
+METRICS_DIR = os.path.join(FACE_INDEX_DIR, "metrics")
+FACE_INDEX_FORMAT_VERSION = 1
+MODEL_NAME = "buffalo_l"
+EMBEDDING_DIM = 512
 MAX_PREPROCESSING_SIZE = 1024
 ### INSIGHTFACE UPDATE ###
 # The new threshold for cosine similarity. Higher is a better match.
@@ -26,23 +157,208 @@ MAX_PREPROCESSING_SIZE = 1024
 SIMILARITY_THRESHOLD = 0.55
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+logger.setLevel(LOG_LEVEL)
+
 # --- Ensure directories exist ---
 if not os.path.exists(EVENT_PHOTOS_DIR):
     os.makedirs(EVENT_PHOTOS_DIR)
-    print(f"Created directory: {EVENT_PHOTOS_DIR}")
+    logger.info(f"Created directory: {EVENT_PHOTOS_DIR}")
 
 # --- Global variables ---
-KNOWN_ENCODINGS_DATA = []
+# The searchable gallery: the L2-normalized float32 base matrix (memory-mapped)
+# plus an over-allocated in-memory delta holding faces appended since the last
+# load/compaction (first KNOWN_DELTA_COUNT rows valid). KNOWN_FACE_PHOTO_IDX maps
+# base rows followed by delta rows to KNOWN_PHOTO_PATHS. Writers serialize on
+# INDEX_UPDATE_LOCK; INDEX_LOCK only guards the short swaps readers snapshot.
+INDEX_LOCK = threading.Lock()
+INDEX_UPDATE_LOCK = threading.RLock()
+COMPACTION_LOCK = threading.Lock()
+KNOWN_PHOTO_PATHS = []
+KNOWN_INDEXED_PATHS = set()
+KNOWN_EMBEDDINGS = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+KNOWN_DELTA_EMBEDDINGS = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+KNOWN_DELTA_COUNT = 0
+KNOWN_FACE_PHOTO_IDX = np.empty(0, dtype=np.int32)
+# Bumped whenever the base matrix is swapped; row ids in ANN_INDEX are only valid
+# for the generation it was built for.
+INDEX_GENERATION = 0
+ANN_INDEX = None
+# (codes, per-dimension scale or None, error bound) when INDEX_PRECISION != "float32".
+KNOWN_QUANTIZED = None
+# Identity clusters (see new_cluster_state()) and, per live row, its cluster's state row.
+IDENTITY_CLUSTERS = None
+KNOWN_FACE_CLUSTER_ROWS = np.empty(0, dtype=np.int32)
+# Bumped on every change to the searchable gallery (load or append).
+GALLERY_VERSION = 0
+# What the live index was built from: the base matrix file and the segments
+# applied on top of it (see refresh_index_if_changed()).
+KNOWN_EMBEDDINGS_FILE = None
+KNOWN_SEGMENT_NAMES = set()
+INDEX_MARKER_SEEN = None
+INDEX_WATCHER = None
 ### INSIGHTFACE UPDATE ###
 # Initialize a global variable for the FaceAnalysis model.
 
 FACE_APP = None
 
+# Ingestion queue state, see start_ingest_dispatcher().
+INGEST_QUEUE = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+INGEST_JOBS = OrderedDict()
+INGEST_JOBS_LOCK = threading.Lock()
+INGEST_EXECUTOR = None
+INGEST_EXECUTOR_LOCK = threading.Lock()
+INGEST_DISPATCHER = None
+INGEST_DISPATCHER_LOCK = threading.Lock()
+
+# Selfie inference pool, see run_selfie_inference().
+INFERENCE_EXECUTOR = None
+INFERENCE_SLOTS = threading.BoundedSemaphore(INFERENCE_THREADS + INFERENCE_QUEUE_SIZE)
+
 # --- Helper Functions ---
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Metrics ---
+METRICS_LOCK = threading.Lock()
+# (pipeline, stage) -> {"buckets": per-bucket counts, "sum", "count", "recent": deque}
+STAGE_METRICS = {}
+# (name, sorted label items) -> value
+COUNTERS = {}
+
+@contextmanager
+def timed_stage(timings, stage):
+    """Adds the block's duration to timings[stage]; observe_stages() records them."""
+    start = time.perf_counter()
+    try: yield
+    finally: timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def observe_stages(pipeline, timings):
+    with METRICS_LOCK:
+        for stage, seconds in timings.items():
+            metric = STAGE_METRICS.get((pipeline, stage))
+            if metric is None:
+                metric = STAGE_METRICS[(pipeline, stage)] = {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0,
+                                                             "recent": deque(maxlen=METRICS_RECENT_SAMPLES)}
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound: metric["buckets"][i] += 1; break
+            metric["sum"] += seconds; metric["count"] += 1
+            metric["recent"].append(seconds)
+
+def increment_counter(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK: COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+def _metric_labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}" if labels else ""
+
+def metrics_state():
+    """This process's metrics as JSON-friendly data; cache hits/misses become counters."""
+    with METRICS_LOCK:
+        stages = {f"{pipeline}/{stage}": dict(metric, buckets=list(metric["buckets"]), recent=list(metric["recent"]))
+                  for (pipeline, stage), metric in STAGE_METRICS.items()}
+        counters = [[name, dict(labels), value] for (name, labels), value in COUNTERS.items()]
+    for cache_name, cache in (("embeddings", EMBEDDING_CACHE), ("results", RESULT_CACHE)):
+        stats = cache_stats(cache)
+        counters += [["cache_lookups_total", {"cache": cache_name, "result": "hit"}, stats["hits"]],
+                     ["cache_lookups_total", {"cache": cache_name, "result": "miss"}, stats["misses"]]]
+    return {"stages": stages, "counters": counters, "ingest_queue_depth": INGEST_QUEUE.qsize()}
+
+def merge_metrics(total, state, keep_recent=True):
+    """Adds state's histograms and counters into total (both as returned by metrics_state)."""
+    for key, metric in state["stages"].items():
+        merged = total["stages"].setdefault(key, {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0, "recent": []})
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], metric["buckets"])]
+        merged["sum"] += metric["sum"]; merged["count"] += metric["count"]
+        if keep_recent: merged["recent"] = merged["recent"] + list(metric["recent"])
+    counters = {(name, tuple(sorted(labels.items()))): value for name, labels, value in total["counters"]}
+    for name, labels, value in state["counters"]:
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+    total["counters"] = [[name, dict(labels), value] for (name, labels), value in counters.items()]
+    return total
+
+def publish_metrics():
+    """Writes this process's metrics where the other server processes' /metrics can add them up."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _atomic_write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), metrics_state())
+
+def _process_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass # Exists, owned by someone else.
+    return True
+
+def _retire_metrics(path):
+    """Folds an exited process's metrics into retired.json (once, even if several workers notice)."""
+    retired_path = os.path.join(METRICS_DIR, "retired.json")
+    # Its own lock: the index lock is held for whole compactions and rescans, far longer than a scrape may take.
+    with file_lock(os.path.join(METRICS_DIR, ".lock")):
+        try:
+            with open(path, 'r') as f: state = json.load(f)
+        except OSError: return # Already retired by another process.
+        except ValueError: os.remove(path); return
+        try:
+            with open(retired_path, 'r') as f: retired = json.load(f)
+        except (OSError, ValueError): retired = {"stages": {}, "counters": []}
+        _atomic_write_json(retired_path, merge_metrics(retired, state, keep_recent=False))
+        os.remove(path)
+
+def collect_metrics():
+    """Metrics summed over this process, the other live server processes and exited ones."""
+    total = merge_metrics({"stages": {}, "counters": []}, metrics_state())
+    total["ingest_queue_depth"], total["processes"] = INGEST_QUEUE.qsize(), 1
+    if fcntl is None or not os.path.isdir(METRICS_DIR): return total # Windows: single server process.
+    for name in os.listdir(METRICS_DIR):
+        pid = name[:-len(".json")]
+        if not name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid(): continue
+        path = os.path.join(METRICS_DIR, name)
+        if not _process_alive(int(pid)):
+            try: _retire_metrics(path)
+            except OSError as e: logger.warning(f"Could not retire metrics of process {pid}: {e}")
+            continue
+        try:
+            with open(path, 'r') as f: state = json.load(f)
+        except (OSError, ValueError): continue
+        merge_metrics(total, state)
+        total["ingest_queue_depth"] += state.get("ingest_queue_depth", 0); total["processes"] += 1
+    try:
+        with open(os.path.join(METRICS_DIR, "retired.json"), 'r') as f: merge_metrics(total, json.load(f), keep_recent=False)
+    except (OSError, ValueError): pass
+    return total
+
+def render_metrics():
+    """Metrics of all server processes (see collect_metrics) in the Prometheus text exposition format."""
+    lines = ["# HELP snaptrace_stage_seconds Latency of each search/ingest pipeline stage.", "# TYPE snaptrace_stage_seconds histogram"]
+    quantile_lines = ["# HELP snaptrace_stage_recent_seconds p50/p99 latency over recent observations of each stage.",
+                      "# TYPE snaptrace_stage_recent_seconds gauge"]
+    metrics = collect_metrics()
+    stages = sorted((tuple(key.split("/", 1)), metric) for key, metric in metrics["stages"].items())
+    counters = sorted((name, tuple(sorted(labels.items())), value) for name, labels, value in metrics["counters"])
+    for (pipeline, stage), metric in stages:
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS, metric["buckets"]):
+            cumulative += count
+            lines.append(f"snaptrace_stage_seconds_bucket{_metric_labels(pipeline=pipeline, stage=stage, le=bound)} {cumulative}")
+        lines.append(f"snaptrace_stage_seconds_bucket{_metric_labels(pipeline=pipeline, stage=stage, le='+Inf')} {metric['count']}")
+        lines.append(f"snaptrace_stage_seconds_sum{_metric_labels(pipeline=pipeline, stage=stage)} {metric['sum']:.6f}")
+        lines.append(f"snaptrace_stage_seconds_count{_metric_labels(pipeline=pipeline, stage=stage)} {metric['count']}")
+        for quantile in (0.5, 0.99) if metric["recent"] else ():
+            quantile_lines.append(f"snaptrace_stage_recent_seconds{_metric_labels(pipeline=pipeline, stage=stage, quantile=quantile)} "
+                                  f"{float(np.quantile(metric['recent'], quantile)):.6f}")
+    lines += quantile_lines
+    declared = set()
+    for name, labels, value in counters:
+        if name not in declared: lines.append(f"# TYPE snaptrace_{name} counter"); declared.add(name)
+        lines.append(f"snaptrace_{name}{_metric_labels(**dict(labels))} {value}")
+    snapshot = get_index_snapshot()
+    lines += ["# TYPE snaptrace_gallery_photos gauge", f"snaptrace_gallery_photos {len(snapshot['photo_paths'])}",
+              "# TYPE snaptrace_gallery_faces gauge", f"snaptrace_gallery_faces {len(snapshot['face_photo_idx'])}",
+              "# TYPE snaptrace_ingest_queue_depth gauge", f"snaptrace_ingest_queue_depth {metrics['ingest_queue_depth']}",
+              "# TYPE snaptrace_server_processes gauge", f"snaptrace_server_processes {metrics['processes']}"]
+    return "\n".join(lines) + "\n"
+
 # --- Image Utility Functions ---
 def resize_image_if_needed(image_cv2, max_size):
     h, w = image_cv2.shape[:2]
@@ -52,136 +368,1502 @@ def resize_image_if_needed(image_cv2, max_size):
         return cv2.resize(image_cv2, (new_w, new_h), interpolation=cv2.INTER_AREA)
     return image_cv2
 
+# JPEG start-of-frame markers carry the image size (DHT/JPG/DAC share the range but do not).
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def read_jpeg_size(stream):
+    """Returns (width, height) from a JPEG's frame header without decoding it, or None if not a JPEG."""
+    if stream.read(2) != b'\xff\xd8': return None
+    while True:
+        byte = stream.read(1)
+        while byte and byte != b'\xff': byte = stream.read(1)
+        while byte == b'\xff': byte = stream.read(1) # Skip fill bytes.
+        if not byte: return None
+        marker = byte[0]
+        if marker == 0xD9 or marker == 0xDA: return None # End of image / start of scan before any frame header.
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01: continue # Markers without a length field.
+        length_bytes = stream.read(2)
+        if len(length_bytes) < 2: return None
+        length = int.from_bytes(length_bytes, 'big')
+        if marker in _JPEG_SOF_MARKERS:
+            frame = stream.read(5)
+            if len(frame) < 5: return None
+            return int.from_bytes(frame[3:5], 'big'), int.from_bytes(frame[1:3], 'big')
+        stream.seek(length - 2, io.SEEK_CUR)
+
+def reduced_decode_flag(size, max_size):
+    """
+    Picks the largest DCT-domain downscale (1/8, 1/4, 1/2) that still leaves the
+    long side at or above max_size, so libjpeg skips most of the work and the final
+    INTER_AREA resize only has a small step left. OpenCV applies EXIF orientation in
+    the reduced modes as well, and rotation does not change the long side.
+    """
+    if size is None: return cv2.IMREAD_COLOR
+    for factor, flag in _REDUCED_DECODE_FLAGS:
+        if max(size) // factor >= max_size: return flag
+    return cv2.IMREAD_COLOR
+
 def image_to_rgb(image_path_or_bytes, for_preprocessing=False):
-    print(f"image_to_rgb: Called. for_preprocessing={for_preprocessing}")
+    logger.debug("image_to_rgb: Called. for_preprocessing=%s", for_preprocessing)
     try:
         img_bgr = None # Initialize
         if isinstance(image_path_or_bytes, str):
-            img_bgr = cv2.imread(image_path_or_bytes)
-        elif isinstance(image_path_or_bytes, bytes):
+            read_flag = cv2.IMREAD_COLOR
+            if for_preprocessing:
+                with open(image_path_or_bytes, 'rb') as f: read_flag = reduced_decode_flag(read_jpeg_size(f), MAX_PREPROCESSING_SIZE)
+            img_bgr = cv2.imread(image_path_or_bytes, read_flag)
+        elif isinstance(image_path_or_bytes, (bytes, bytearray, memoryview)):
             nparr = np.frombuffer(image_path_or_bytes, np.uint8)
-            img_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            read_flag = cv2.IMREAD_COLOR
+            if for_preprocessing: read_flag = reduced_decode_flag(read_jpeg_size(io.BytesIO(nparr)), MAX_PREPROCESSING_SIZE)
+            img_bgr = cv2.imdecode(nparr, read_flag)
         else:
-            print(f"image_to_rgb: Received unsupported type: {type(image_path_or_bytes)}")
+            logger.error(f"image_to_rgb: Received unsupported type: {type(image_path_or_bytes)}")
             return None
         
         if img_bgr is None:
-            print(f"image_to_rgb: img_bgr is None after attempting to load/decode.")
+            logger.debug("image_to_rgb: img_bgr is None after attempting to load/decode.")
             return None
 
         if for_preprocessing:
             img_bgr = resize_image_if_needed(img_bgr, MAX_PREPROCESSING_SIZE)
 
-        rgb_img = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-        return rgb_img
+        # The decoded/resized buffer is ours alone, so convert it in place instead of copying the frame.
+        return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst=img_bgr)
     except Exception as e:
-        print(f"CRITICAL ERROR in image_to_rgb: {e}")
-        traceback.print_exc()
+        logger.exception(f"CRITICAL ERROR in image_to_rgb: {e}")
         return None
 
+# --- Photo Derivatives ---
+def derivative_path(image_path, size_name):
+    return os.path.join(DERIVATIVES_DIR, size_name, os.path.basename(image_path))
+
+def _derivative_is_current(image_path, size_name):
+    path = derivative_path(image_path, size_name)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(image_path)
+
+def write_photo_derivatives(image_path, size_names=None):
+    """
+    Writes the missing or stale DERIVATIVE_SIZES copies of a photo, largest first,
+    each resized from the previous one. The decode is DCT-scaled to the largest
+    size needed. Returns False if the photo could not be decoded.
+    """
+    size_names = [name for name in (size_names or DERIVATIVE_SIZES) if not _derivative_is_current(image_path, name)]
+    if not size_names: return True
+    size_names.sort(key=lambda name: -DERIVATIVE_SIZES[name])
+    with open(image_path, 'rb') as f: read_flag = reduced_decode_flag(read_jpeg_size(f), DERIVATIVE_SIZES[size_names[0]])
+    img_bgr = cv2.imread(image_path, read_flag)
+    if img_bgr is None: return False
+    for name in size_names:
+        img_bgr = resize_image_if_needed(img_bgr, DERIVATIVE_SIZES[name])
+        path = derivative_path(image_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Temp name keeps the extension so OpenCV picks the same encoder.
+        tmp_path = os.path.join(os.path.dirname(path), f".tmp-{os.getpid()}-{threading.get_ident()}-{os.path.basename(path)}")
+        if not cv2.imwrite(tmp_path, img_bgr, [cv2.IMWRITE_JPEG_QUALITY, DERIVATIVE_JPEG_QUALITY]): return False
+        os.replace(tmp_path, path)
+    return True
+
+def create_face_app():
+    """Loads and prepares the InsightFace model. Raises if it cannot be initialized."""
+    if FaceAnalysis is None: raise RuntimeError("insightface is not installed (pip install insightface==0.7.3 onnxruntime).")
+    # For CPU usage
+    face_app = FaceAnalysis(name=MODEL_NAME, providers=['CPUExecutionProvider'])
+
+    # --- UNCOMMENT FOR GPU USAGE ---
+    # If you have a compatible NVIDIA GPU and have installed 'onnxruntime-gpu', use this instead:
+    # print("Attempting to use CUDA (GPU) for InsightFace.")
+    # face_app = FaceAnalysis(name=MODEL_NAME, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
+
+    face_app.prepare(ctx_id=0, det_size=(640, 640))
+    return face_app
+
+def warm_up_face_app(face_app):
+    """Runs one detection and one recognition pass so the first real request does not pay ONNX Runtime's start-up cost."""
+    face_app.get(np.zeros((640, 640, 3), dtype=np.uint8))
+    recognition = getattr(face_app, "models", {}).get("recognition")
+    if recognition is not None: recognition.get_feat(np.zeros((112, 112, 3), dtype=np.uint8))
+
 ### INSIGHTFACE UPDATE ###
 # A new helper function to get encodings using the InsightFace model.
 # This replaces face_recognition.face_encodings and face_locations.
-def get_face_encodings_from_image(image_rgb):
+def get_face_encodings_from_image(image_rgb, timings=None):
     if FACE_APP is None:
-        print("ERROR: InsightFace model (FACE_APP) is not initialized.")
+        logger.error("InsightFace model (FACE_APP) is not initialized.")
         return []
+    timings = {} if timings is None else timings
     try:
-        faces = FACE_APP.get(image_rgb)
-        # The 'embedding' is the face encoding vector
-        return [face['embedding'] for face in faces]
+        detector, recognizer = getattr(FACE_APP, "det_model", None), getattr(FACE_APP, "models", {}).get("recognition")
+        if detector is None or recognizer is None:
+            with timed_stage(timings, "detect_embed"): faces = FACE_APP.get(image_rgb)
+            # The 'embedding' is the face encoding vector
+            return [face['embedding'] for face in faces]
+        # Same steps as FaceAnalysis.get(), timed separately. Only the recognition
+        # model runs per face: landmarks and gender/age are never used here.
+        with timed_stage(timings, "detect"): bboxes, kpss = detector.detect(image_rgb, max_num=0, metric='default')
+        with timed_stage(timings, "embed"):
+            return [recognizer.get(image_rgb, Face(bbox=bboxes[i, 0:4], kps=None if kpss is None else kpss[i], det_score=bboxes[i, 4]))
+                    for i in range(bboxes.shape[0])]
     except Exception as e:
-        print(f"Error during InsightFace processing: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error during InsightFace processing: {e}")
         return []
 
-# --- Optimized Preprocessing for Specific Files ---
-def process_specific_new_photos(new_photo_paths):
-    if not new_photo_paths:
-        return "No new photos provided for specific processing."
-    all_encodings_data = []
-    if os.path.exists(ENCODINGS_FILE):
-        try:
-            with open(ENCODINGS_FILE, 'r') as f: all_encodings_data = json.load(f)
-        except json.JSONDecodeError:
-            print(f"Warning: {ENCODINGS_FILE} corrupted. Starting fresh for these files.")
-            all_encodings_data = []
-    existing_paths_in_json = {item['image_path'] for item in all_encodings_data}
-    processed_count = 0
-    for image_path in new_photo_paths:
-        if image_path in existing_paths_in_json:
-            print(f"Skipping {image_path} as it's already in encodings (specific processing).")
-            continue
-        print(f"Specifically processing: {image_path}...")
-        image_rgb = image_to_rgb(image_path, for_preprocessing=True)
-        if image_rgb is None:
-            print(f"Failed to load {image_path} for specific processing. Skipping.")
-            all_encodings_data.append({"image_path": image_path, "encodings": [], "error": "load_failed_specific"})
-            continue
-        
-        ### INSIGHTFACE UPDATE ###
-        # Use the new helper function for getting encodings.
-        current_image_encodings = get_face_encodings_from_image(image_rgb)
-        
-        serializable_encodings = [enc.tolist() for enc in current_image_encodings]
-        all_encodings_data.append({"image_path": image_path, "encodings": serializable_encodings})
-        if serializable_encodings: print(f"Found {len(serializable_encodings)} face(s) in new photo {os.path.basename(image_path)}")
-        else: print(f"No faces found in new photo {os.path.basename(image_path)}")
-        processed_count += 1
-    if processed_count > 0 or not os.path.exists(ENCODINGS_FILE):
+# --- Binary Face Index Store ---
+def normalize_embeddings(matrix):
+    """L2-normalizes each row. Returns (normalized_rows, valid_mask); zero-norm rows are invalid."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1: matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1)
+    valid = norms > 0
+    normalized = np.zeros_like(matrix)
+    normalized[valid] = matrix[valid] / norms[valid, None]
+    return normalized, valid
+
+# Optional per-photo manifest fields: file fingerprint and duplicate marker.
+PHOTO_METADATA_KEYS = ("size", "mtime_ns", "sha1", "duplicate_of")
+
+def records_to_index(records):
+    """
+    Converts [{"image_path", "encodings", "error"?}] records into manifest photo
+    entries plus one normalized float32 matrix whose rows are grouped by photo.
+    Zero-norm encodings are dropped.
+    """
+    photos, face_blocks = [], []
+    for item in records:
+        entry = {"image_path": item["image_path"], "num_faces": 0}
+        entry.update({key: item[key] for key in PHOTO_METADATA_KEYS if item.get(key) is not None})
+        if item.get("error"): entry["error"] = item["error"]
+        elif len(item.get("encodings", [])) > 0:
+            normalized, valid = normalize_embeddings(item["encodings"])
+            if valid.any():
+                face_blocks.append(normalized[valid])
+                entry["num_faces"] = int(valid.sum())
+        photos.append(entry)
+    if face_blocks: embeddings = np.ascontiguousarray(np.concatenate(face_blocks), dtype=np.float32)
+    else: embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return photos, embeddings
+
+def _atomic_write_json(path, payload):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f: json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+def _shared_state_path(directory, state_id):
+    """JSON file for a job or result set; None for ids that are not ours (uuid4 hex)."""
+    if not re.fullmatch(r"[0-9a-f]{32}", state_id or ""): return None
+    return os.path.join(directory, state_id + ".json")
+
+def write_shared_state(directory, state_id, payload):
+    os.makedirs(directory, exist_ok=True)
+    _atomic_write_json(_shared_state_path(directory, state_id), payload)
+
+def read_shared_state(directory, state_id, max_age=None):
+    """Payload written by any server process, or None if missing, unreadable or older than max_age."""
+    path = _shared_state_path(directory, state_id)
+    if path is None: return None
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age: return None
+        with open(path, 'r') as f: return json.load(f)
+    except (OSError, ValueError): return None
+
+def prune_shared_state(directory, keep=None, max_age=None):
+    """Removes state files older than max_age and, oldest first, all but the newest keep."""
+    try: entries = [entry for entry in os.scandir(directory) if entry.name.endswith(".json")]
+    except OSError: return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    now = time.time()
+    for position, entry in enumerate(entries):
+        if (keep is not None and position >= keep) or (max_age is not None and now - entry.stat().st_mtime > max_age):
+            try: os.remove(entry.path)
+            except OSError: pass
+
+def write_face_index(photos, embeddings, merged_segments=()):
+    """
+    Atomically replaces the face index. The matrix goes to a uniquely named .npy
+    file first and the manifest pointing at it is swapped in last, so readers
+    (including other processes still memory-mapping the old matrix) never see a
+    half-written index. merged_segments lists segments already folded into it.
+    """
+    os.makedirs(FACE_INDEX_DIR, exist_ok=True)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if sum(photo["num_faces"] for photo in photos) != len(embeddings):
+        raise ValueError("Face counts in manifest do not match the number of embedding rows.")
+    token = f"{time.time_ns()}-{os.getpid()}"
+    embeddings_file = f"embeddings-{token}.npy"
+    tmp_path = os.path.join(FACE_INDEX_DIR, embeddings_file + ".tmp")
+    with open(tmp_path, 'wb') as f: np.save(f, embeddings)
+    os.replace(tmp_path, os.path.join(FACE_INDEX_DIR, embeddings_file))
+    clusters_file = None
+    if CLUSTERING_ENABLED and len(embeddings):
+        # Keep existing cluster ids, cluster any rows that have none yet, and store
+        # the centroid sums so loading does not need a pass over the whole matrix.
+        clusters = new_cluster_state()
+        cluster_rows = add_labelled_rows(clusters, embeddings, photo_cluster_ids(photos))
+        unlabelled = np.flatnonzero(cluster_rows < 0)
+        if unlabelled.size:
+            cluster_rows[unlabelled] = assign_to_clusters(clusters, embeddings[unlabelled])
+            photos = with_cluster_ids(photos, clusters["ids"][cluster_rows])
+        clusters_file = f"clusters-{token}.npz"
+        with open(os.path.join(FACE_INDEX_DIR, clusters_file + ".tmp"), 'wb') as f:
+            np.savez(f, ids=clusters["ids"][:clusters["count"]], sums=clusters["sums"][:clusters["count"]])
+        os.replace(os.path.join(FACE_INDEX_DIR, clusters_file + ".tmp"), os.path.join(FACE_INDEX_DIR, clusters_file))
+    _atomic_write_json(FACE_INDEX_MANIFEST, {
+        "format_version": FACE_INDEX_FORMAT_VERSION,
+        "model": MODEL_NAME,
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else EMBEDDING_DIM,
+        "dtype": "float32",
+        "normalized": True,
+        "embeddings_file": embeddings_file,
+        "clusters_file": clusters_file,
+        "num_faces": int(len(embeddings)),
+        "updated_at": time.time(),
+        "merged_segments": sorted(merged_segments),
+        "photos": photos,
+    })
+    _atomic_write_json(FACE_INDEX_VERSION_MARKER, {"embeddings_file": embeddings_file, "updated_at": time.time()})
+    # Unlinking is safe for processes that still have an old matrix mapped.
+    for name in os.listdir(FACE_INDEX_DIR):
+        if ((name.startswith("embeddings-") and name.endswith(".npy") and name != embeddings_file)
+                or (name.startswith("clusters-") and name.endswith(".npz") and name != clusters_file)):
+            try: os.remove(os.path.join(FACE_INDEX_DIR, name))
+            except OSError: pass
+
+def read_face_index(mmap=True):
+    """Returns (manifest, embeddings) or (None, None) when no index exists."""
+    if not os.path.exists(FACE_INDEX_MANIFEST): return None, None
+    with open(FACE_INDEX_MANIFEST, 'r') as f: manifest = json.load(f)
+    if manifest.get("format_version") != FACE_INDEX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face index format: {manifest.get('format_version')}")
+    if manifest.get("model") != MODEL_NAME:
+        logger.warning(f"face index was built with model '{manifest.get('model')}', running '{MODEL_NAME}'.")
+    embeddings = np.load(os.path.join(FACE_INDEX_DIR, manifest["embeddings_file"]), mmap_mode='r' if mmap else None)
+    if embeddings.dtype != np.float32 or embeddings.ndim != 2 or len(embeddings) != manifest["num_faces"]:
+        raise ValueError("Face index matrix does not match its manifest.")
+    return manifest, embeddings
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Exclusive lock on path shared by all server processes. Yields whether it was
+    acquired: with blocking=False it yields False instead of waiting for a holder.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        if fcntl:
+            try: fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError: yield False; return
+        try: yield True
+        finally:
+            if fcntl: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def face_index_file_lock():
+    """Serializes full index rewrites (compaction, rescans) across server processes."""
+    return file_lock(os.path.join(FACE_INDEX_DIR, ".lock"))
+
+def append_face_index_segment(photos, embeddings, directory=FACE_INDEX_SEGMENTS_DIR):
+    """
+    Writes new photos as an immutable segment. The .npy is written first and the
+    .json sidecar is renamed into place last; readers ignore segments without it.
+    Names are unique per process, so concurrent uploads never overwrite each other.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f"seg-{time.time_ns()}-{os.getpid()}-{threading.get_ident()}"
+    base_path = os.path.join(directory, name)
+    with open(base_path + ".npy.tmp", 'wb') as f: np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+    os.replace(base_path + ".npy.tmp", base_path + ".npy")
+    _atomic_write_json(base_path + ".json", {"model": MODEL_NAME, "num_faces": int(len(embeddings)), "photos": photos})
+    if directory == FACE_INDEX_SEGMENTS_DIR: touch_index_version_marker()
+    return name
+
+def touch_index_version_marker():
+    """Signals a new segment to other server processes (the base matrix is unchanged)."""
+    now = time.time_ns()
+    try: os.utime(FACE_INDEX_VERSION_MARKER, ns=(now, now))
+    except FileNotFoundError: _atomic_write_json(FACE_INDEX_VERSION_MARKER, {"embeddings_file": KNOWN_EMBEDDINGS_FILE, "updated_at": time.time()})
+
+def list_face_index_segments(directory=FACE_INDEX_SEGMENTS_DIR):
+    """Names of committed segments, oldest first."""
+    if not os.path.isdir(directory): return []
+    return sorted(name[:-len(".json")] for name in os.listdir(directory)
+                  if name.startswith("seg-") and name.endswith(".json"))
+
+def read_face_index_segments(skip=(), directory=FACE_INDEX_SEGMENTS_DIR, names=None):
+    """Returns [(name, photos, embeddings)] for committed segments (or just names) not in skip."""
+    segments, skip = [], set(skip)
+    for name in list_face_index_segments(directory) if names is None else names:
+        if name in skip: continue
+        base_path = os.path.join(directory, name)
         try:
-            with open(ENCODINGS_FILE, 'w') as f: json.dump(all_encodings_data, f, indent=2)
-            message = f"Specifically processed {processed_count} new photo(s). Encodings updated."
-            print(message); return message
-        except IOError as e: message = f"Error writing encodings (specific): {e}"; print(message); return message
-    else: return "No new photos were actually processed from the list."
+            with open(base_path + ".json", 'r') as f: segment_manifest = json.load(f)
+            embeddings = np.load(base_path + ".npy")
+        except (IOError, ValueError) as e:
+            logger.warning(f"skipping unreadable segment {name}: {e}"); continue
+        if len(embeddings) != segment_manifest["num_faces"]:
+            logger.warning(f"skipping segment {name}: row count does not match its manifest."); continue
+        segments.append((name, segment_manifest["photos"], embeddings))
+    return segments
+
+def remove_face_index_segments(names, directory=FACE_INDEX_SEGMENTS_DIR):
+    for name in names:
+        for suffix in (".json", ".npy"): # Sidecar first: a half-removed segment is never read.
+            try: os.remove(os.path.join(directory, name + suffix))
+            except OSError: pass
+
+def drop_known_photos(photos, embeddings, known_paths):
+    """Filters out photos (and their rows) whose path is already in known_paths."""
+    keep_photos, keep_rows, row = [], [], 0
+    for photo in photos:
+        if photo["image_path"] not in known_paths:
+            keep_photos.append(photo)
+            keep_rows.extend(range(row, row + photo["num_faces"]))
+        row += photo["num_faces"]
+    if len(keep_photos) == len(photos): return photos, embeddings
+    return keep_photos, embeddings[np.asarray(keep_rows, dtype=np.int64)]
+
+def compact_face_index():
+    """Folds all pending segments into a new base matrix and reloads the live index."""
+    with COMPACTION_LOCK, face_index_file_lock():
+        manifest, base_embeddings = read_face_index(mmap=True)
+        already_merged = manifest.get("merged_segments", []) if manifest else []
+        segments = read_face_index_segments(skip=already_merged)
+        if not segments: return "No segments to compact."
+        photos = list(manifest["photos"]) if manifest else []
+        blocks = [base_embeddings] if manifest else []
+        known_paths = {photo["image_path"] for photo in photos}
+        for _, segment_photos, segment_embeddings in segments:
+            segment_photos, segment_embeddings = drop_known_photos(segment_photos, segment_embeddings, known_paths)
+            known_paths.update(photo["image_path"] for photo in segment_photos)
+            photos.extend(segment_photos); blocks.append(segment_embeddings)
+        merged = [name for name, _, _ in segments]
+        # Keep listing older merged segments whose files could not be removed.
+        merged += [name for name in already_merged if name in set(list_face_index_segments())]
+        write_face_index(photos, np.concatenate(blocks), merged_segments=merged)
+        remove_face_index_segments(merged)
+    load_known_encodings()
+    message = f"Compacted {len(segments)} segment(s) into the face index."
+    logger.info(message); return message
+
+def merge_face_index_segments():
+    """Rewrites all pending segments as one segment; the base matrix is left alone."""
+    with COMPACTION_LOCK, face_index_file_lock():
+        manifest = read_face_index(mmap=True)[0]
+        segments = read_face_index_segments(skip=manifest.get("merged_segments", []) if manifest else [])
+        if len(segments) < 2: return "No segments to merge."
+        photos, blocks, known_paths = [], [], set()
+        for _, segment_photos, segment_embeddings in segments:
+            segment_photos, segment_embeddings = drop_known_photos(segment_photos, segment_embeddings, known_paths)
+            known_paths.update(photo["image_path"] for photo in segment_photos)
+            photos.extend(segment_photos); blocks.append(segment_embeddings)
+        # Other processes see a new segment whose photos they already have and skip them.
+        name = append_face_index_segment(photos, np.concatenate(blocks))
+        remove_face_index_segments([segment_name for segment_name, _, _ in segments])
+    with INDEX_UPDATE_LOCK: KNOWN_SEGMENT_NAMES.add(name)
+    message = f"Merged {len(segments)} segment(s) into {name}."
+    logger.info(message); return message
+
+def schedule_compaction_if_needed():
+    if COMPACTION_LOCK.locked(): return
+    if KNOWN_DELTA_COUNT >= max(COMPACTION_MIN_FACES, COMPACTION_DELTA_FRACTION * len(KNOWN_EMBEDDINGS)): task = compact_face_index
+    elif len(list_face_index_segments()) >= SEGMENT_MERGE_THRESHOLD: task = merge_face_index_segments
+    else: return
+    def run():
+        try: task()
+        except Exception as e: logger.exception(f"Error during face index compaction: {e}")
+    threading.Thread(target=run, name="face-index-compaction", daemon=True).start()
+
+def migrate_json_encodings():
+    """One-time conversion of the legacy ENCODINGS_FILE into the binary face index."""
+    logger.info(f"Migrating {ENCODINGS_FILE} to binary face index in {FACE_INDEX_DIR}...")
+    try:
+        with open(ENCODINGS_FILE, 'r') as f: data_from_file = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logger.error(f"{ENCODINGS_FILE} could not be read for migration: {e}")
+        return False
+    records = []
+    for item in data_from_file:
+        if "image_path" not in item: continue
+        encodings = [enc for enc in item.get("encodings", []) if isinstance(enc, list)]
+        records.append({"image_path": item["image_path"], "encodings": encodings, "error": item.get("error")})
+    photos, embeddings = records_to_index(records)
+    write_face_index(photos, embeddings)
+    logger.info(f"Migrated {len(photos)} photos / {len(embeddings)} faces.")
+    return True
+
+# --- Optimized Preprocessing for Specific Files ---
+def index_new_records(records):
+    """
+    Assigns freshly embedded records to identity clusters, appends them as a
+    segment and applies them to the live index. Returns the newly indexed photos.
+    """
+    photos, embeddings = records_to_index(records)
+    with INDEX_UPDATE_LOCK:
+        if IDENTITY_CLUSTERS is None: load_known_encodings()
+        photos, embeddings = drop_known_photos(photos, embeddings, KNOWN_INDEXED_PATHS)
+        if not photos: return []
+        if CLUSTERING_ENABLED and len(embeddings):
+            cluster_rows = assign_to_clusters(IDENTITY_CLUSTERS, embeddings)
+            photos = with_cluster_ids(photos, IDENTITY_CLUSTERS["ids"][cluster_rows])
+        KNOWN_SEGMENT_NAMES.add(append_face_index_segment(photos, embeddings))
+        append_to_live_index(photos, embeddings)
+    schedule_compaction_if_needed()
+    return photos
 
 # --- Full Preprocessing Logic (Admin/Initial Scan) ---
-def preprocess_event_photos_on_demand():
-    print("Admin: Performing full event photo directory scan and processing...")
-    temp_encodings_data = []
-    processed_this_run_count = 0
-    for filename in os.listdir(EVENT_PHOTOS_DIR):
-        if not allowed_file(filename): continue
-        image_path = os.path.join(EVENT_PHOTOS_DIR, filename)
-        print(f"Full scan processing: {image_path}...")
-        image_rgb = image_to_rgb(image_path, for_preprocessing=True)
-        if image_rgb is None:
-            print(f"Full scan: Failed to load {image_path}. Skipping.")
-            temp_encodings_data.append({"image_path": image_path, "encodings": [], "error": "load_failed_full_scan"})
-            continue
+RESCAN_LOCK = threading.Lock()
+RESCAN_LOCK_FILE = os.path.join(FACE_INDEX_DIR, ".rescan.lock")
+RESCAN_ALREADY_RUNNING = "A full scan is already running."
+
+def file_fingerprint(image_path, previous=None):
+    """Returns {"size", "mtime_ns", "sha1"}; the hash is reused from previous when size and mtime are unchanged."""
+    stat = os.stat(image_path)
+    if previous and previous.get("sha1") and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": previous["sha1"]}
+    digest = hashlib.sha1()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): digest.update(chunk)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": digest.hexdigest()}
+
+def _same_file_version(entry, fingerprint):
+    """True if entry holds this file's own embeddings (not an error, and not a stand-in for another copy)."""
+    return (entry is not None and not entry.get("error") and not entry.get("duplicate_of")
+            and entry.get("sha1") == fingerprint["sha1"])
+
+def _indexed_photo_rows(segment_names=None):
+    """
+    Maps image_path -> (manifest entry, face rows) across the base index and its
+    pending segments (only those in segment_names, if given).
+    """
+    rows_by_path = {}
+    manifest, base_embeddings = read_face_index(mmap=True)
+    sources = [(manifest["photos"], base_embeddings)] if manifest else []
+    merged = manifest.get("merged_segments", []) if manifest else []
+    sources += [(photos, embeddings) for _, photos, embeddings in read_face_index_segments(skip=merged, names=segment_names)]
+    for photos, embeddings in sources:
+        row = 0
+        for photo in photos:
+            rows_by_path[photo["image_path"]] = (photo, embeddings[row:row + photo["num_faces"]])
+            row += photo["num_faces"]
+    return rows_by_path
+
+def preprocess_event_photos_on_demand(workers=None, restart=False):
+    """
+    Rebuilds the face index from EVENT_PHOTOS_DIR. Photos whose content hash is
+    unchanged since they were indexed keep their embeddings, byte-identical copies
+    under another name are recorded as duplicates, and the rest are embedded by a
+    pool of worker processes. Results are checkpointed to RESCAN_CHECKPOINT_DIR so
+    an interrupted rescan resumes instead of starting over (unless restart=True).
+    """
+    if not RESCAN_LOCK.acquire(blocking=False): return RESCAN_ALREADY_RUNNING
+    try:
+        # RESCAN_LOCK covers this process's threads, the lock file the other server processes.
+        with file_lock(RESCAN_LOCK_FILE, blocking=False) as acquired:
+            if not acquired: return RESCAN_ALREADY_RUNNING
+            return _run_full_rescan(RESCAN_WORKERS if workers is None else workers, restart)
+    finally: RESCAN_LOCK.release()
+
+def _run_full_rescan(workers, restart):
+    logger.info(f"Admin: Performing full event photo directory scan with {workers} worker(s)...")
+    if restart: remove_face_index_segments(list_face_index_segments(RESCAN_CHECKPOINT_DIR), RESCAN_CHECKPOINT_DIR)
+    try: previous_rows = _indexed_photo_rows()
+    except Exception as e: logger.info(f"Full scan: existing index unreadable ({e}); re-embedding everything."); previous_rows = {}
+    indexed_before_scan = set(previous_rows)
+    # Checkpointed results from an interrupted run take precedence over the old index.
+    checkpoints = read_face_index_segments(directory=RESCAN_CHECKPOINT_DIR)
+    for _, photos, embeddings in checkpoints:
+        row = 0
+        for photo in photos:
+            previous_rows[photo["image_path"]] = (photo, embeddings[row:row + photo["num_faces"]])
+            row += photo["num_faces"]
+    image_paths = [os.path.join(EVENT_PHOTOS_DIR, filename) for filename in sorted(os.listdir(EVENT_PHOTOS_DIR)) if allowed_file(filename)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as hash_pool: # hashlib releases the GIL
+        fingerprints = list(hash_pool.map(lambda path: file_fingerprint(path, previous_rows.get(path, (None,))[0]), image_paths))
+
+    # Of byte-identical copies, keep the one already indexed (so nothing is re-embedded
+    # and users keep getting the same filename); otherwise the first in sorted order.
+    canonical_by_sha1 = {}
+    for image_path, fingerprint in zip(image_paths, fingerprints):
+        canonical = canonical_by_sha1.get(fingerprint["sha1"])
+        if canonical is None or (not _same_file_version(previous_rows.get(canonical, (None,))[0], fingerprint)
+                                 and _same_file_version(previous_rows.get(image_path, (None,))[0], fingerprint)):
+            canonical_by_sha1[fingerprint["sha1"]] = image_path
+    final_entries, to_embed = {}, []
+    reused_count, duplicate_count = 0, 0
+    for image_path, fingerprint in zip(image_paths, fingerprints):
+        canonical = canonical_by_sha1[fingerprint["sha1"]]
+        if canonical != image_path:
+            final_entries[image_path] = ({"image_path": image_path, "num_faces": 0, "duplicate_of": canonical, **fingerprint}, None)
+            duplicate_count += 1; continue
+        previous = previous_rows.get(image_path)
+        if previous and _same_file_version(previous[0], fingerprint):
+            final_entries[image_path] = (dict(previous[0], **fingerprint), previous[1])
+            reused_count += 1; continue
+        to_embed.append((image_path, fingerprint))
+    logger.info(f"Full scan: {len(image_paths)} photos, {reused_count} unchanged, {duplicate_count} duplicates, {len(to_embed)} to process.")
 
-        ### INSIGHTFACE UPDATE ###
-        # Use the new helper function for getting encodings.
-        current_image_encodings = get_face_encodings_from_image(image_rgb)
+    pending_records, processed_this_run_count = [], 0
+    def flush_checkpoint():
+        if pending_records:
+            append_face_index_segment(*records_to_index(pending_records), directory=RESCAN_CHECKPOINT_DIR)
+            pending_records.clear()
+    fingerprint_by_path = dict(to_embed)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_ingest_worker, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        results = executor.map(embed_photo_for_ingest, [path for path, _ in to_embed], chunksize=4) if executor else map(embed_photo_for_ingest, [path for path, _ in to_embed])
+        for image_path, encodings, error, _, timings in results:
+            observe_stages("rescan", timings)
+            increment_counter("rescan_photos_total", result="failed" if error else "embedded")
+            record = {"image_path": image_path, "encodings": encodings, **fingerprint_by_path[image_path]}
+            if error:
+                logger.warning(f"Full scan: Failed to load {image_path}. Skipping.")
+                record["error"] = "load_failed_full_scan"
+            elif encodings: logger.debug("Full scan: Found %d face(s) in %s", len(encodings), image_path)
+            else: logger.debug("Full scan: No faces found in %s", image_path)
+            photos, embeddings = records_to_index([record])
+            final_entries[image_path] = (photos[0], embeddings)
+            pending_records.append(record)
+            processed_this_run_count += 1
+            if len(pending_records) >= RESCAN_CHECKPOINT_EVERY: flush_checkpoint()
+    finally:
+        flush_checkpoint() # Keep whatever finished, even if the scan was interrupted.
+        if executor: executor.shutdown()
+
+    photos, blocks = [], []
+    for image_path in image_paths:
+        entry, rows = final_entries[image_path]
+        duplicate_of = entry.get("duplicate_of")
+        if duplicate_of and (duplicate_of not in final_entries or final_entries[duplicate_of][0].get("duplicate_of")):
+            # Every duplicate must point at a copy indexed in this scan, or its faces are unsearchable.
+            message = f"Full scan: {image_path} is recorded as a duplicate of {duplicate_of}, which is not indexed."
+            logger.error(message); return message
+        photos.append(entry)
+        if rows is not None and len(rows): blocks.append(rows)
+    try:
+        with face_index_file_lock():
+            # Photos indexed by uploads while the scan ran are not in image_paths; carry
+            # them forward (wherever they are now) so superseding the segments keeps them.
+            # Uploads do not take this lock, so only segments listed here are superseded.
+            superseded_segments = list_face_index_segments()
+            try: current_rows = _indexed_photo_rows(superseded_segments)
+            except Exception: current_rows = {}
+            scanned_paths = set(image_paths)
+            for image_path, (entry, rows) in current_rows.items():
+                if image_path in scanned_paths or image_path in indexed_before_scan: continue
+                photos.append(entry)
+                if rows is not None and len(rows): blocks.append(rows)
+            embeddings = np.concatenate(blocks) if blocks else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+            write_face_index(photos, embeddings, merged_segments=superseded_segments)
+            remove_face_index_segments(superseded_segments)
+        remove_face_index_segments(list_face_index_segments(RESCAN_CHECKPOINT_DIR), RESCAN_CHECKPOINT_DIR)
+        message = (f"Full scan complete. Processed {processed_this_run_count} photos, reused {reused_count} unchanged, "
+                   f"skipped {duplicate_count} duplicates. Encodings overwritten.")
+        logger.info(message); return message
+    except (IOError, ValueError) as e: message = f"Error writing encodings (full scan): {e}"; logger.error(message); return message
+
+# --- Background Ingestion Queue ---
+def _init_ingest_worker():
+    """Runs once in each ingest worker process: loads that worker's own model."""
+    global FACE_APP
+    FACE_APP = create_face_app()
+
+def embed_photo_for_ingest(image_path):
+    """
+    Worker task: returns (image_path, encodings, error, fingerprint, timings). Stage
+    timings travel back with the result because workers are separate processes.
+    """
+    timings = {}
+    with timed_stage(timings, "hash"):
+        try: fingerprint = file_fingerprint(image_path)
+        except OSError: fingerprint = {}
+    with timed_stage(timings, "decode"): image_rgb = image_to_rgb(image_path, for_preprocessing=True)
+    if image_rgb is None: return image_path, [], "load_failed_ingest", fingerprint, timings
+    encodings = get_face_encodings_from_image(image_rgb, timings)
+    with timed_stage(timings, "derivatives"):
+        try: write_photo_derivatives(image_path)
+        except Exception as e: logger.error(f"Could not write derivatives for {image_path}: {e}") # Served lazily instead.
+    return image_path, encodings, None, fingerprint, timings
+
+def _get_ingest_executor():
+    global INGEST_EXECUTOR
+    with INGEST_EXECUTOR_LOCK:
+        if INGEST_EXECUTOR is None:
+            if INGEST_WORKERS > 0:
+                # 'spawn' keeps workers clear of the server's threads and locks.
+                INGEST_EXECUTOR = ProcessPoolExecutor(max_workers=INGEST_WORKERS, initializer=_init_ingest_worker,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+            else:
+                INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        return INGEST_EXECUTOR
 
-        serializable_encodings = [enc.tolist() for enc in current_image_encodings]
-        temp_encodings_data.append({"image_path": image_path, "encodings": serializable_encodings})
-        if serializable_encodings: print(f"Full scan: Found {len(serializable_encodings)} face(s) in {filename}")
-        else: print(f"Full scan: No faces found in {filename}")
-        processed_this_run_count += 1
+def _discard_broken_ingest_executor(executor):
+    """Drops a pool whose worker died; every failed future reports it, so only the first caller acts."""
+    global INGEST_EXECUTOR
+    with INGEST_EXECUTOR_LOCK:
+        if INGEST_EXECUTOR is not executor: return
+        INGEST_EXECUTOR = None
+    executor.shutdown(wait=False)
+
+def create_ingest_job(image_paths):
+    job_id = uuid.uuid4().hex
+    job = {"job_id": job_id, "status": "queued", "total": len(image_paths), "processed": 0, "failed": 0,
+           "faces_indexed": 0, "errors": [], "created_at": time.time(), "started_at": None, "finished_at": None}
+    with INGEST_JOBS_LOCK:
+        INGEST_JOBS[job_id] = job
+        while len(INGEST_JOBS) > MAX_TRACKED_JOBS:
+            oldest_id = next(iter(INGEST_JOBS))
+            if INGEST_JOBS[oldest_id]["status"] != "completed": break
+            INGEST_JOBS.pop(oldest_id)
+        save_ingest_job(job)
+    prune_shared_state(INGEST_JOBS_DIR, keep=MAX_TRACKED_JOBS)
+    return job
+
+def save_ingest_job(job):
+    """Publishes a job's progress to the other server processes. Call with INGEST_JOBS_LOCK held."""
+    try: write_shared_state(INGEST_JOBS_DIR, job["job_id"], job)
+    except OSError as e: logger.warning(f"Could not save status of ingest job {job['job_id']}: {e}")
+
+def get_ingest_job_status(job_id):
+    with INGEST_JOBS_LOCK:
+        job = INGEST_JOBS.get(job_id)
+        status = dict(job, errors=list(job["errors"])) if job is not None else None
+    if status is None: status = read_shared_state(INGEST_JOBS_DIR, job_id) # Started by another process.
+    if status is None: return None
+    done = status["processed"] + status["failed"]
+    if status["started_at"]:
+        elapsed = (status["finished_at"] or time.time()) - status["started_at"]
+        status["photos_per_second"] = round(done / elapsed, 3) if elapsed > 0 else None
+    status["pending"] = status["total"] - done
+    return status
+
+def _finish_ingest_file(job_id, image_path, encodings, error, fingerprint=None, timings=None):
+    """Indexes one finished photo (searchable immediately) and updates its job."""
+    faces_indexed, timings = 0, dict(timings or {})
     try:
-        with open(ENCODINGS_FILE, 'w') as f: json.dump(temp_encodings_data, f, indent=2)
-        message = f"Full scan complete. Processed {processed_this_run_count} photos. Encodings overwritten."
-        print(message); return message
-    except IOError as e: message = f"Error writing encodings (full scan): {e}"; print(message); return message
+        with timed_stage(timings, "index"):
+            photos = index_new_records([{"image_path": image_path, "encodings": encodings, "error": error, **(fingerprint or {})}])
+        faces_indexed = sum(photo["num_faces"] for photo in photos)
+    except Exception as e:
+        logger.error(f"Error indexing {image_path}: {e}"); error = error or f"index_failed: {e}"
+    _update_ingest_job(job_id, image_path, error, faces_indexed, timings)
+
+def _update_ingest_job(job_id, image_path, error, faces_indexed=0, timings=None):
+    """
+    Records one photo's outcome on its job. Infrastructure failures (full queue,
+    dead worker) come here directly: the photo is not indexed, so a re-upload retries it.
+    """
+    if timings: observe_stages("ingest", timings)
+    increment_counter("ingest_photos_total", result="failed" if error else "indexed")
+    increment_counter("faces_indexed_total", faces_indexed)
+    with INGEST_JOBS_LOCK:
+        job = INGEST_JOBS.get(job_id)
+        if job is None: return
+        if error:
+            job["failed"] += 1
+            job["errors"].append({"file": os.path.basename(image_path), "error": error})
+        else: job["processed"] += 1
+        job["faces_indexed"] += faces_indexed
+        if job["processed"] + job["failed"] >= job["total"]:
+            job["status"], job["finished_at"] = "completed", time.time()
+            logger.info(f"Ingest job {job_id} completed: {job['processed']} processed, {job['failed']} failed, {job['faces_indexed']} faces indexed.")
+        save_ingest_job(job)
+
+def _on_ingest_done(job_id, image_path, executor, future, slots):
+    try:
+        fingerprint, timings = None, None
+        try: _, encodings, error, fingerprint, timings = future.result()
+        except BrokenProcessPool as e:
+            # A worker died (e.g. out of memory); start a fresh pool for the next file.
+            _discard_broken_ingest_executor(executor)
+            _update_ingest_job(job_id, image_path, f"worker_failed: {e}"); return
+        except Exception as e: _update_ingest_job(job_id, image_path, f"worker_failed: {e}"); return
+        _finish_ingest_file(job_id, image_path, encodings, error, fingerprint, timings)
+    finally: slots.release()
+
+def _ingest_dispatcher():
+    # Keep a couple of files per worker in flight; the rest wait in INGEST_QUEUE.
+    slots = threading.BoundedSemaphore(max(1, INGEST_WORKERS) * 2)
+    while True:
+        job_id, image_path = INGEST_QUEUE.get()
+        slots.acquire()
+        with INGEST_JOBS_LOCK:
+            job = INGEST_JOBS.get(job_id)
+            if job and job["status"] == "queued":
+                job["status"], job["started_at"] = "running", time.time()
+                save_ingest_job(job)
+        executor = _get_ingest_executor()
+        try: future = executor.submit(embed_photo_for_ingest, image_path)
+        except BrokenProcessPool as e:
+            _discard_broken_ingest_executor(executor)
+            slots.release(); _update_ingest_job(job_id, image_path, f"submit_failed: {e}"); continue
+        except Exception as e:
+            slots.release(); _update_ingest_job(job_id, image_path, f"submit_failed: {e}"); continue
+        future.add_done_callback(lambda f, job_id=job_id, image_path=image_path, executor=executor:
+                                 _on_ingest_done(job_id, image_path, executor, f, slots))
+
+def start_ingest_dispatcher():
+    global INGEST_DISPATCHER
+    with INGEST_DISPATCHER_LOCK:
+        if INGEST_DISPATCHER is None or not INGEST_DISPATCHER.is_alive():
+            INGEST_DISPATCHER = threading.Thread(target=_ingest_dispatcher, name="ingest-dispatcher", daemon=True)
+            INGEST_DISPATCHER.start()
+
+def enqueue_ingest_job(image_paths):
+    """Queues saved photos for background embedding and returns the job."""
+    start_ingest_dispatcher()
+    job = create_ingest_job(image_paths)
+    for image_path in image_paths:
+        try: INGEST_QUEUE.put_nowait((job["job_id"], image_path))
+        except queue.Full: _update_ingest_job(job["job_id"], image_path, "ingest_queue_full")
+    if not image_paths:
+        with INGEST_JOBS_LOCK:
+            job["status"], job["finished_at"] = "completed", time.time()
+            save_ingest_job(job)
+    return job
 
 # --- Load Encodings ---
+def _face_rows_for_photos(photos, first_photo_id):
+    """Returns (paths_with_faces, face_photo_idx) for photos whose rows are stored grouped in order."""
+    paths = [photo["image_path"] for photo in photos if photo["num_faces"] > 0]
+    counts = [photo["num_faces"] for photo in photos if photo["num_faces"] > 0]
+    return paths, np.repeat(np.arange(first_photo_id, first_photo_id + len(paths), dtype=np.int32), counts)
+
 def load_known_encodings():
-    global KNOWN_ENCODINGS_DATA
-    if os.path.exists(ENCODINGS_FILE):
-        try:
-            with open(ENCODINGS_FILE, 'r') as f: data_from_file = json.load(f)
-            temp_known_encodings = []
-            for item in data_from_file:
-                if "encodings" in item and isinstance(item["encodings"], list) and not item.get("error"):
-                    numpy_encodings = [np.array(enc) for enc in item["encodings"] if isinstance(enc, list)]
-                    if numpy_encodings: temp_known_encodings.append({"image_path": item["image_path"], "encodings": numpy_encodings})
-            KNOWN_ENCODINGS_DATA = temp_known_encodings
-            print(f"Encodings loaded: {len(KNOWN_ENCODINGS_DATA)} entries with faces available for matching.")
-        except json.JSONDecodeError: print(f"Error: {ENCODINGS_FILE} is corrupted."); KNOWN_ENCODINGS_DATA = []
-        except Exception as e: print(f"Unexpected error loading encodings: {e}"); KNOWN_ENCODINGS_DATA = []
-    else: print(f"Warning: {ENCODINGS_FILE} not found."); KNOWN_ENCODINGS_DATA = []
+    global KNOWN_PHOTO_PATHS, KNOWN_INDEXED_PATHS, KNOWN_EMBEDDINGS, KNOWN_DELTA_EMBEDDINGS, KNOWN_DELTA_COUNT, KNOWN_FACE_PHOTO_IDX
+    global INDEX_GENERATION, ANN_INDEX, KNOWN_QUANTIZED, IDENTITY_CLUSTERS, KNOWN_FACE_CLUSTER_ROWS, GALLERY_VERSION
+    global KNOWN_EMBEDDINGS_FILE, KNOWN_SEGMENT_NAMES
+    with INDEX_UPDATE_LOCK:
+        if not os.path.exists(FACE_INDEX_MANIFEST) and os.path.exists(ENCODINGS_FILE):
+            migrate_json_encodings()
+        manifest, embeddings = None, np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        if os.path.exists(FACE_INDEX_MANIFEST):
+            try: manifest, embeddings = read_face_index(mmap=True)
+            except Exception as e: logger.error(f"face index in {FACE_INDEX_DIR} could not be loaded: {e}"); manifest, embeddings = None, np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        else: logger.warning(f"{FACE_INDEX_MANIFEST} not found.")
+        base_photos = manifest["photos"] if manifest else []
+        photo_paths, base_face_idx = _face_rows_for_photos(base_photos, 0)
+        indexed_paths = {photo["image_path"] for photo in base_photos}
+        # Segments appended since the last compaction become the in-memory delta.
+        delta_photos, delta_blocks, delta_idx_blocks = [], [], []
+        segment_names = set(manifest.get("merged_segments", [])) if manifest else set()
+        for segment_name, segment_photos, segment_embeddings in read_face_index_segments(skip=segment_names):
+            segment_names.add(segment_name)
+            segment_photos, segment_embeddings = drop_known_photos(segment_photos, segment_embeddings, indexed_paths)
+            indexed_paths.update(photo["image_path"] for photo in segment_photos)
+            segment_paths, segment_idx = _face_rows_for_photos(segment_photos, len(photo_paths))
+            photo_paths.extend(segment_paths); delta_photos.extend(segment_photos)
+            delta_blocks.append(segment_embeddings); delta_idx_blocks.append(segment_idx)
+        delta = np.concatenate(delta_blocks) if delta_blocks else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        clusters, cluster_rows = load_identity_clusters(manifest, base_photos, embeddings, delta_photos, delta)
+        quantized = None
+        if INDEX_PRECISION != "float32" and len(embeddings):
+            quantized = quantize_embeddings(embeddings, INDEX_PRECISION)
+            logger.info(f"Searchable index quantized to {INDEX_PRECISION}: {quantized[0].nbytes / 2**20:.1f} MB "
+                        f"(float32: {embeddings.nbytes / 2**20:.1f} MB), re-rank margin {quantized[2]:.4f}.")
+        with INDEX_LOCK:
+            KNOWN_PHOTO_PATHS, KNOWN_INDEXED_PATHS = photo_paths, indexed_paths
+            KNOWN_EMBEDDINGS, KNOWN_DELTA_EMBEDDINGS, KNOWN_DELTA_COUNT = embeddings, delta, len(delta)
+            KNOWN_FACE_PHOTO_IDX = np.concatenate([base_face_idx] + delta_idx_blocks)
+            IDENTITY_CLUSTERS, KNOWN_FACE_CLUSTER_ROWS = clusters, cluster_rows
+            INDEX_GENERATION += 1; ANN_INDEX = None; KNOWN_QUANTIZED = quantized
+            GALLERY_VERSION += 1
+            KNOWN_EMBEDDINGS_FILE = manifest["embeddings_file"] if manifest else None
+            KNOWN_SEGMENT_NAMES = segment_names
+        cache_clear(RESULT_CACHE)
+        schedule_ann_build_if_needed()
+    logger.info(f"Encodings loaded: {len(photo_paths)} photos / {len(embeddings) + len(delta)} faces available for matching ({len(delta)} pending compaction).")
+
+def append_to_live_index(photos, embeddings):
+    """
+    Applies just the delta of a new segment to the live index. Rows are written into
+    spare delta capacity beyond what any reader's snapshot covers, then published by
+    bumping KNOWN_DELTA_COUNT, so searches never see a partial update. Cluster ids
+    in the photo entries must already be assigned (see index_new_records()).
+    """
+    global KNOWN_DELTA_EMBEDDINGS, KNOWN_DELTA_COUNT, KNOWN_FACE_PHOTO_IDX, KNOWN_FACE_CLUSTER_ROWS, GALLERY_VERSION
+    with INDEX_UPDATE_LOCK:
+        photos, embeddings = drop_known_photos(photos, embeddings, KNOWN_INDEXED_PATHS)
+        if not photos: return
+        new_paths, new_face_idx = _face_rows_for_photos(photos, len(KNOWN_PHOTO_PATHS))
+        base_count, delta_count, added = len(KNOWN_EMBEDDINGS), KNOWN_DELTA_COUNT, len(embeddings)
+        delta, face_idx, cluster_rows = KNOWN_DELTA_EMBEDDINGS, KNOWN_FACE_PHOTO_IDX, KNOWN_FACE_CLUSTER_ROWS
+        if delta_count + added > len(delta):
+            capacity = max(delta_count + added, 2 * len(delta), 1024)
+            delta = np.empty((capacity, EMBEDDING_DIM), dtype=np.float32)
+            delta[:delta_count] = KNOWN_DELTA_EMBEDDINGS[:delta_count]
+            face_idx = np.empty(base_count + capacity, dtype=np.int32)
+            face_idx[:base_count + delta_count] = KNOWN_FACE_PHOTO_IDX[:base_count + delta_count]
+            cluster_rows = np.full(base_count + capacity, -1, dtype=np.int32)
+            cluster_rows[:base_count + delta_count] = KNOWN_FACE_CLUSTER_ROWS[:base_count + delta_count]
+        delta[delta_count:delta_count + added] = embeddings
+        face_idx[base_count + delta_count:base_count + delta_count + added] = new_face_idx
+        if CLUSTERING_ENABLED and added:
+            row_by_id = IDENTITY_CLUSTERS["row_by_id"]
+            cluster_rows[base_count + delta_count:base_count + delta_count + added] = [row_by_id[int(c)] for c in photo_cluster_ids(photos)]
+        with INDEX_LOCK:
+            KNOWN_PHOTO_PATHS.extend(new_paths)
+            KNOWN_INDEXED_PATHS.update(photo["image_path"] for photo in photos)
+            KNOWN_DELTA_EMBEDDINGS, KNOWN_FACE_PHOTO_IDX, KNOWN_FACE_CLUSTER_ROWS = delta, face_idx, cluster_rows
+            KNOWN_DELTA_COUNT = delta_count + added
+            GALLERY_VERSION += 1
+        cache_clear(RESULT_CACHE)
+        if ANN_INDEX is not None: ann_add_rows(ANN_INDEX, base_count + delta_count, embeddings)
+        else: schedule_ann_build_if_needed()
+
+def get_index_snapshot():
+    """Consistent view of the live index (base matrix, delta rows, row -> photo map, ANN and quantized copies)."""
+    with INDEX_LOCK:
+        delta_count, total = KNOWN_DELTA_COUNT, len(KNOWN_EMBEDDINGS) + KNOWN_DELTA_COUNT
+        cluster_count = IDENTITY_CLUSTERS["count"] if IDENTITY_CLUSTERS else 0
+        return {
+            "photo_paths": KNOWN_PHOTO_PATHS,
+            "base": KNOWN_EMBEDDINGS,
+            "delta": KNOWN_DELTA_EMBEDDINGS[:delta_count],
+            "face_photo_idx": KNOWN_FACE_PHOTO_IDX[:total],
+            "ann": ANN_INDEX,
+            "quantized": KNOWN_QUANTIZED,
+            "cluster_rows": KNOWN_FACE_CLUSTER_ROWS[:total],
+            "cluster_centroids": IDENTITY_CLUSTERS["centroids"][:cluster_count] if cluster_count else None,
+            "cluster_ids": IDENTITY_CLUSTERS["ids"][:cluster_count] if cluster_count else None,
+            "cluster_row_by_id": IDENTITY_CLUSTERS["row_by_id"] if IDENTITY_CLUSTERS else {},
+        }
+
+def gather_face_rows(base_embeddings, delta_embeddings, rows):
+    """Fetches live-index rows (base rows first, then delta rows) as one float32 matrix."""
+    rows = np.asarray(rows, dtype=np.int64)
+    base_count = len(base_embeddings)
+    if rows.size == 0 or rows.max() < base_count: return np.asarray(base_embeddings[rows])
+    if rows.min() >= base_count: return delta_embeddings[rows - base_count]
+    gathered = np.empty((len(rows), base_embeddings.shape[1]), dtype=np.float32)
+    in_base = rows < base_count
+    gathered[in_base] = base_embeddings[rows[in_base]]
+    gathered[~in_base] = delta_embeddings[rows[~in_base] - base_count]
+    return gathered
+
+# --- Multi-Process Index Updates ---
+def apply_external_segment(photos, embeddings):
+    """Applies a segment written by another server process to the live index."""
+    with INDEX_UPDATE_LOCK:
+        photos, embeddings = drop_known_photos(photos, embeddings, KNOWN_INDEXED_PATHS)
+        if not photos: return
+        if CLUSTERING_ENABLED and len(embeddings):
+            # Its faces are not in our centroid sums yet; clusters new to us are created.
+            cluster_rows = add_labelled_rows(IDENTITY_CLUSTERS, embeddings, photo_cluster_ids(photos))
+            unlabelled = np.flatnonzero(cluster_rows < 0)
+            if unlabelled.size:
+                cluster_rows[unlabelled] = assign_to_clusters(IDENTITY_CLUSTERS, embeddings[unlabelled])
+                photos = with_cluster_ids(photos, IDENTITY_CLUSTERS["ids"][cluster_rows])
+        append_to_live_index(photos, embeddings)
+
+def refresh_index_if_changed():
+    """
+    Picks up gallery changes made by other processes. Only the small version
+    marker is checked on each call: a new base matrix (compaction or rescan)
+    reloads the index, and new segments are read and applied on their own.
+    """
+    global INDEX_MARKER_SEEN
+    try: marker_mtime = os.stat(FACE_INDEX_VERSION_MARKER).st_mtime_ns
+    except FileNotFoundError: return False
+    if marker_mtime == INDEX_MARKER_SEEN: return False
+    with open(FACE_INDEX_VERSION_MARKER, 'r') as f: marker = json.load(f)
+    with INDEX_UPDATE_LOCK:
+        if IDENTITY_CLUSTERS is None or marker.get("embeddings_file") != KNOWN_EMBEDDINGS_FILE: load_known_encodings()
+        else:
+            for name, photos, embeddings in read_face_index_segments(skip=KNOWN_SEGMENT_NAMES):
+                apply_external_segment(photos, embeddings)
+                KNOWN_SEGMENT_NAMES.add(name)
+        INDEX_MARKER_SEEN = marker_mtime
+    return True
+
+def _watch_face_index():
+    while True:
+        time.sleep(INDEX_WATCH_INTERVAL_SECONDS)
+        # A failed refresh (e.g. a segment removed mid-read by compaction) is retried on the next poll.
+        try: refresh_index_if_changed()
+        except Exception as e: logger.error(f"Error refreshing face index: {e}")
+        try: publish_metrics()
+        except OSError as e: logger.warning(f"Could not publish metrics: {e}")
+
+def start_index_watcher():
+    global INDEX_WATCHER
+    if INDEX_WATCHER is None:
+        INDEX_WATCHER = threading.Thread(target=_watch_face_index, name="face-index-watcher", daemon=True)
+        INDEX_WATCHER.start()
+
+# --- Identity Clusters ---
+def new_cluster_state(capacity=1024):
+    """Over-allocated cluster buffers; the first "count" rows are valid."""
+    return {"ids": np.empty(capacity, dtype=np.int64), "sums": np.zeros((capacity, EMBEDDING_DIM), dtype=np.float32),
+            "centroids": np.zeros((capacity, EMBEDDING_DIM), dtype=np.float32), "count": 0, "row_by_id": {}}
+
+def _new_cluster_id():
+    # Random 48-bit ids stay unique across server processes and survive compaction.
+    return uuid.uuid4().int >> 80
+
+def _cluster_row(clusters, cluster_id):
+    """Returns the state row of cluster_id, adding an empty cluster if it is new."""
+    row = clusters["row_by_id"].get(cluster_id)
+    if row is not None: return row
+    row = clusters["count"]
+    if row == len(clusters["ids"]):
+        grown = new_cluster_state(2 * row)
+        for key in ("ids", "sums", "centroids"): grown[key][:row] = clusters[key][:row]
+        with INDEX_LOCK: clusters.update(ids=grown["ids"], sums=grown["sums"], centroids=grown["centroids"])
+    clusters["ids"][row] = cluster_id
+    clusters["row_by_id"][cluster_id] = row
+    clusters["count"] = row + 1
+    return row
+
+def add_labelled_rows(clusters, embeddings, cluster_ids, chunk_size=65536):
+    """Adds rows that already carry a cluster id (>= 0) to their clusters. Returns state rows, -1 for unlabelled rows."""
+    rows = np.full(len(cluster_ids), -1, dtype=np.int32)
+    labelled = np.flatnonzero(cluster_ids >= 0)
+    if labelled.size == 0: return rows
+    unique_ids, inverse = np.unique(cluster_ids[labelled], return_inverse=True)
+    rows[labelled] = np.array([_cluster_row(clusters, int(cluster_id)) for cluster_id in unique_ids], dtype=np.int32)[inverse]
+    for start in range(0, labelled.size, chunk_size):
+        chunk = labelled[start:start + chunk_size]
+        np.add.at(clusters["sums"], rows[chunk], np.asarray(embeddings[chunk], dtype=np.float32))
+    touched = np.unique(rows[labelled])
+    clusters["centroids"][touched] = normalize_embeddings(clusters["sums"][touched])[0]
+    return rows
+
+def assign_to_clusters(clusters, embeddings, threshold=None, chunk_size=1024):
+    """
+    Incremental leader clustering: each row joins its closest centroid if the
+    similarity reaches the threshold, otherwise it starts a new cluster; centroids
+    are running normalized means. Returns the state row of every input row.
+    """
+    threshold = CLUSTER_ASSIGN_THRESHOLD if threshold is None else threshold
+    rows = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        known = clusters["count"]
+        if known:
+            similarities = chunk @ clusters["centroids"][:known].T
+            best = similarities.argmax(axis=1)
+            best_similarity = similarities[np.arange(len(chunk)), best]
+        else: best, best_similarity = np.zeros(len(chunk), dtype=np.int64), np.full(len(chunk), -np.inf)
+        for i, face in enumerate(chunk):
+            row = int(best[i]) if best_similarity[i] >= threshold else -1
+            if clusters["count"] > known: # Clusters started earlier in this chunk.
+                new_similarities = clusters["centroids"][known:clusters["count"]] @ face
+                j = int(new_similarities.argmax())
+                if new_similarities[j] >= max(threshold, best_similarity[i]): row = known + j
+            if row < 0: row = _cluster_row(clusters, _new_cluster_id())
+            clusters["sums"][row] += face
+            clusters["centroids"][row] = clusters["sums"][row] / (np.linalg.norm(clusters["sums"][row]) or 1)
+            rows[start + i] = row
+    return rows
+
+def photo_cluster_ids(photos):
+    """Per-row cluster ids from manifest photo entries (-1 for rows not clustered yet)."""
+    return np.array([cluster_id for photo in photos if photo["num_faces"] > 0
+                     for cluster_id in (photo.get("cluster_ids") or [-1] * photo["num_faces"])], dtype=np.int64)
+
+def with_cluster_ids(photos, cluster_ids):
+    """Copies of the photo entries with their rows' cluster ids recorded."""
+    updated, row = [], 0
+    for photo in photos:
+        if photo["num_faces"] > 0:
+            photo = dict(photo, cluster_ids=[int(cluster_id) for cluster_id in cluster_ids[row:row + photo["num_faces"]]])
+            row += photo["num_faces"]
+        updated.append(photo)
+    return updated
+
+def load_identity_clusters(manifest, base_photos, base_embeddings, delta_photos, delta_embeddings):
+    """Rebuilds the cluster state for the live index. Returns (clusters, cluster row of every live row)."""
+    clusters = new_cluster_state()
+    total = len(base_embeddings) + len(delta_embeddings)
+    cluster_rows = np.full(total, -1, dtype=np.int32)
+    if not CLUSTERING_ENABLED or total == 0: return clusters, cluster_rows
+    base_ids = photo_cluster_ids(base_photos)
+    clusters_file = manifest.get("clusters_file") if manifest else None
+    if clusters_file and os.path.exists(os.path.join(FACE_INDEX_DIR, clusters_file)):
+        with np.load(os.path.join(FACE_INDEX_DIR, clusters_file)) as stored:
+            clusters = new_cluster_state(max(1024, 2 * len(stored["ids"])))
+            for cluster_id, cluster_sum in zip(stored["ids"], stored["sums"]):
+                row = _cluster_row(clusters, int(cluster_id))
+                clusters["sums"][row] = cluster_sum
+        clusters["centroids"][:clusters["count"]] = normalize_embeddings(clusters["sums"][:clusters["count"]])[0]
+        row_by_id = clusters["row_by_id"]
+        cluster_rows[:len(base_embeddings)] = [row_by_id.get(int(cluster_id), -1) for cluster_id in base_ids]
+    elif len(base_embeddings):
+        logger.info("Clustering gallery faces (index predates identity clusters)...")
+        cluster_rows[:len(base_embeddings)] = add_labelled_rows(clusters, base_embeddings, base_ids)
+    if len(delta_embeddings):
+        cluster_rows[len(base_embeddings):] = add_labelled_rows(clusters, delta_embeddings, photo_cluster_ids(delta_photos))
+    unlabelled = np.flatnonzero(cluster_rows < 0)
+    if unlabelled.size:
+        cluster_rows[unlabelled] = assign_to_clusters(clusters, gather_face_rows(base_embeddings, delta_embeddings, unlabelled))
+    return clusters, cluster_rows
+
+def cluster_candidate_rows(snapshot, query):
+    """Live rows belonging to the clusters whose centroids are close to the query."""
+    similarities = snapshot["cluster_centroids"] @ query
+    selected = similarities >= CLUSTER_QUERY_THRESHOLD
+    closest = min(CLUSTER_QUERY_MIN_CLUSTERS, len(similarities))
+    if closest: selected[np.argpartition(-similarities, closest - 1)[:closest]] = True
+    cluster_rows = snapshot["cluster_rows"]
+    return np.flatnonzero(selected[cluster_rows] & (cluster_rows >= 0))
+
+def best_identity_cluster(user_encoding_norm):
+    """Id of the cluster whose centroid best matches the query, if it clears SIMILARITY_THRESHOLD."""
+    snapshot = get_index_snapshot()
+    if snapshot["cluster_centroids"] is None: return None
+    similarities = snapshot["cluster_centroids"] @ np.asarray(user_encoding_norm, dtype=np.float32)
+    best = int(similarities.argmax())
+    return int(snapshot["cluster_ids"][best]) if similarities[best] > SIMILARITY_THRESHOLD else None
+
+def identity_cluster_photos(cluster_id):
+    """Image paths containing faces of the given cluster, or None for an unknown cluster."""
+    snapshot = get_index_snapshot()
+    row = snapshot["cluster_row_by_id"].get(cluster_id)
+    if row is None: return None
+    faces = np.flatnonzero(snapshot["cluster_rows"] == row)
+    return [snapshot["photo_paths"][i] for i in np.unique(snapshot["face_photo_idx"][faces])]
+
+# --- Quantized Search Copy ---
+def quantize_embeddings(embeddings, precision, chunk_size=65536):
+    """
+    Returns (codes, scale, error_bound) for a compact copy of normalized rows.
+    error_bound is the largest possible |approximate - exact| cosine similarity
+    for a unit-length query, so re-scoring everything within it of the threshold
+    reproduces the exact result.
+    """
+    if precision == "float16":
+        codes = np.empty(embeddings.shape, dtype=np.float16)
+        for start in range(0, len(embeddings), chunk_size): codes[start:start + chunk_size] = embeddings[start:start + chunk_size]
+        # Relative rounding error 2^-11 per component; Cauchy-Schwarz bounds the dot product error.
+        return codes, None, 2.0 ** -11 + 1e-5
+    if precision == "int8":
+        max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for start in range(0, len(embeddings), chunk_size):
+            np.maximum(max_abs, np.abs(embeddings[start:start + chunk_size]).max(axis=0), out=max_abs)
+        scale = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        for start in range(0, len(embeddings), chunk_size):
+            codes[start:start + chunk_size] = np.rint(embeddings[start:start + chunk_size] / scale)
+        # Rounding error is at most scale/2 per component.
+        return codes, scale, float(0.5 * np.linalg.norm(scale)) + 1e-5
+    raise ValueError(f"Unsupported INDEX_PRECISION: {precision}")
+
+def quantized_scores(quantized, query, rows=None, chunk_size=2048):
+    """Approximate similarities of the query against quantized base rows (all rows when rows is None)."""
+    codes, scale, _ = quantized
+    query = query * scale if scale is not None else query
+    if rows is not None: return codes[rows].astype(np.float32) @ query
+    scores = np.empty(len(codes), dtype=np.float32)
+    # Widen one cache-sized chunk at a time so the float32 temporary stays small.
+    for start in range(0, len(codes), chunk_size):
+        scores[start:start + chunk_size] = codes[start:start + chunk_size].astype(np.float32) @ query
+    return scores
+
+# --- Approximate Nearest-Neighbour Index ---
+ANN_BUILD_LOCK = threading.Lock()
+
+def _nearest_centroids(centroids, matrix, chunk_size=65536):
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk_size):
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+def _spherical_kmeans(sample, nlist, iterations, rng):
+    """k-means on the unit sphere (cosine similarity), returning normalized centroids."""
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest_centroids(centroids, sample)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=nlist)
+        non_empty = np.flatnonzero(counts)
+        sums = np.add.reduceat(sample[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty])
+        centroids[non_empty] = sums
+        empty = np.flatnonzero(counts == 0)
+        if empty.size: centroids[empty] = sample[rng.choice(len(sample), empty.size, replace=False)]
+        centroids, _ = normalize_embeddings(centroids)
+    return centroids
+
+def build_ann_index(base_embeddings, delta_embeddings, nlist=None, seed=0):
+    """
+    Builds an IVF index: a spherical k-means coarse quantizer plus, for every
+    centroid, the list of face rows assigned to it (stored CSR-style). Rows added
+    later go to per-list "extra" buckets via ann_add_rows().
+    """
+    total = len(base_embeddings) + len(delta_embeddings)
+    nlist = min(total, nlist or ANN_NLIST or max(1, int(4 * np.sqrt(total))))
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(total, min(total, max(ANN_TRAIN_SAMPLE, nlist)), replace=False))
+    centroids = _spherical_kmeans(gather_face_rows(base_embeddings, delta_embeddings, sample_rows), nlist, ANN_KMEANS_ITERATIONS, rng)
+    assignments = np.concatenate([_nearest_centroids(centroids, base_embeddings), _nearest_centroids(centroids, delta_embeddings)])
+    order = np.argsort(assignments, kind='stable').astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))])
+    return {"centroids": centroids, "offsets": offsets, "rows": order, "extra": {}, "num_rows": total}
+
+def ann_add_rows(ann_index, first_row, embeddings):
+    """Assigns newly appended rows to their nearest lists so they are searchable right away."""
+    if len(embeddings) == 0: return
+    for offset, list_id in enumerate(_nearest_centroids(ann_index["centroids"], embeddings)):
+        ann_index["extra"].setdefault(int(list_id), []).append(first_row + offset)
+    ann_index["num_rows"] = max(ann_index["num_rows"], first_row + len(embeddings))
+
+def ann_candidate_rows(ann_index, query, nprobe, max_row):
+    """Rows in the nprobe lists whose centroids are closest to the query, limited to rows < max_row."""
+    nprobe = min(nprobe, len(ann_index["centroids"]))
+    probe = np.argpartition(-(ann_index["centroids"] @ query), nprobe - 1)[:nprobe]
+    offsets, rows, extra = ann_index["offsets"], ann_index["rows"], ann_index["extra"]
+    parts = [rows[offsets[list_id]:offsets[list_id + 1]] for list_id in probe]
+    parts += [np.asarray(extra[int(list_id)][:], dtype=np.int64) for list_id in probe if int(list_id) in extra]
+    candidates = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+    return np.sort(candidates[candidates < max_row])
+
+def _build_ann_in_background(generation):
+    global ANN_INDEX
+    try:
+        with ANN_BUILD_LOCK:
+            snapshot = get_index_snapshot()
+            if INDEX_GENERATION != generation: return
+            start = time.time()
+            ann_index = build_ann_index(snapshot["base"], snapshot["delta"])
+            with INDEX_UPDATE_LOCK:
+                if INDEX_GENERATION != generation: return
+                # Catch up with rows appended while the index was being built.
+                built_rows, live_rows = ann_index["num_rows"], len(KNOWN_EMBEDDINGS) + KNOWN_DELTA_COUNT
+                if live_rows > built_rows:
+                    ann_add_rows(ann_index, built_rows, gather_face_rows(KNOWN_EMBEDDINGS, KNOWN_DELTA_EMBEDDINGS, np.arange(built_rows, live_rows)))
+                with INDEX_LOCK: ANN_INDEX = ann_index
+            logger.info(f"ANN index built: {len(ann_index['centroids'])} lists over {ann_index['num_rows']} faces in {time.time() - start:.1f}s.")
+    except Exception as e:
+        logger.exception(f"Error building ANN index: {e}")
+
+def ann_search_in_use():
+    """False while cluster search takes precedence, so the IVF index would never be queried."""
+    return ANN_ENABLED and not (CLUSTERING_ENABLED and LARGE_GALLERY_STRATEGY == "clusters")
+
+def schedule_ann_build_if_needed():
+    if not ann_search_in_use() or ANN_INDEX is not None or ANN_BUILD_LOCK.locked(): return
+    if len(KNOWN_EMBEDDINGS) + KNOWN_DELTA_COUNT < ANN_MIN_FACES: return
+    threading.Thread(target=_build_ann_in_background, args=(INDEX_GENERATION,), name="ann-build", daemon=True).start()
+
+# --- Similarity Search ---
+def _rank_photos(photo_paths, face_photo_idx, rows, similarities, threshold):
+    """Keeps each photo's best face above the threshold and returns [(image_path, score)], best first."""
+    hits = similarities > threshold
+    if not hits.any(): return []
+    best_scores = np.full(len(photo_paths), -np.inf, dtype=np.float32)
+    np.maximum.at(best_scores, face_photo_idx[rows[hits]], similarities[hits])
+    matched = np.flatnonzero(best_scores > threshold)
+    ranked = matched[np.argsort(-best_scores[matched], kind='stable')]
+    return [(photo_paths[i], float(best_scores[i])) for i in ranked]
+
+def _exact_scores(snapshot, query, rows):
+    """float32 similarities for the given live-index rows (every row when rows is None)."""
+    if rows is not None: return gather_face_rows(snapshot["base"], snapshot["delta"], rows) @ query
+    similarities = snapshot["base"] @ query
+    if len(snapshot["delta"]): similarities = np.concatenate([similarities, snapshot["delta"] @ query])
+    return similarities
+
+def _approximate_scores(snapshot, query, rows):
+    """Like _exact_scores, but base rows are scored on the quantized copy (delta rows stay float32)."""
+    base_count, delta = len(snapshot["base"]), snapshot["delta"]
+    if rows is None:
+        scores = quantized_scores(snapshot["quantized"], query)
+        return np.concatenate([scores, delta @ query]) if len(delta) else scores
+    scores = np.empty(len(rows), dtype=np.float32)
+    in_base = rows < base_count
+    scores[in_base] = quantized_scores(snapshot["quantized"], query, rows[in_base])
+    scores[~in_base] = delta[rows[~in_base] - base_count] @ query
+    return scores
+
+def search_known_encodings(user_encoding_norm, threshold=SIMILARITY_THRESHOLD, strategy="auto", nprobe=None):
+    """
+    Returns [(image_path, score)] for photos whose best face beats the threshold,
+    best match first. Candidate faces come from the chosen strategy: "exact"
+    scores every face with one matrix-vector product, "clusters" only members of
+    identity clusters near the query, "ann" only the nprobe closest IVF lists.
+    "auto" picks ANN or clusters (LARGE_GALLERY_STRATEGY first) once the gallery
+    is large enough for them.
+    With a quantized index the candidates are scored on the compact copy first
+    and only those within its error bound of the threshold are re-scored at full
+    precision.
+    """
+    snapshot = get_index_snapshot()
+    photo_paths, face_photo_idx = snapshot["photo_paths"], snapshot["face_photo_idx"]
+    if not photo_paths: return []
+    query = np.asarray(user_encoding_norm, dtype=np.float32)
+    if strategy == "auto":
+        use_clusters = snapshot["cluster_centroids"] is not None and len(face_photo_idx) >= CLUSTER_SEARCH_MIN_FACES
+        use_ann = snapshot["ann"] is not None and len(face_photo_idx) >= ANN_MIN_FACES
+        if use_ann and (LARGE_GALLERY_STRATEGY == "ann" or not use_clusters): strategy = "ann"
+        elif use_clusters: strategy = "clusters"
+    rows = None
+    if strategy == "clusters" and snapshot["cluster_centroids"] is not None:
+        rows = cluster_candidate_rows(snapshot, query)
+    elif strategy == "ann" and snapshot["ann"] is not None:
+        rows = ann_candidate_rows(snapshot["ann"], query, nprobe or ANN_NPROBE, len(face_photo_idx))
+    if snapshot["quantized"] is not None:
+        approximate = _approximate_scores(snapshot, query, rows)
+        near_threshold = np.flatnonzero(approximate > threshold - snapshot["quantized"][2])
+        rows = near_threshold if rows is None else rows[near_threshold]
+    similarities = _exact_scores(snapshot, query, rows)
+    if rows is None: rows = np.arange(len(face_photo_idx))
+    return _rank_photos(photo_paths, face_photo_idx, rows, similarities, threshold)
+
+def _recall_against_exact(snapshot, fast_search, num_queries, noise, seed):
+    """
+    Compares fast_search with exact search at SIMILARITY_THRESHOLD. Queries are
+    gallery faces perturbed with Gaussian noise (a stand-in for a new selfie of the
+    same person); recall is the fraction of exactly-matched photos fast_search finds.
+    """
+    face_photo_idx = snapshot["face_photo_idx"]
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(face_photo_idx), min(num_queries, len(face_photo_idx)), replace=False)
+    queries = gather_face_rows(snapshot["base"], snapshot["delta"], np.sort(rows))
+    queries, _ = normalize_embeddings(queries + rng.normal(0, noise / np.sqrt(queries.shape[1]), queries.shape).astype(np.float32))
+    recalls, exact_times, fast_times = [], [], []
+    for query in queries:
+        start = time.perf_counter(); exact_paths = {path for path, _ in search_known_encodings(query, strategy="exact")}
+        exact_times.append(time.perf_counter() - start)
+        start = time.perf_counter(); fast_paths = {path for path, _ in fast_search(query)}
+        fast_times.append(time.perf_counter() - start)
+        if exact_paths: recalls.append(len(exact_paths & fast_paths) / len(exact_paths))
+    return {
+        "queries": len(queries), "queries_with_matches": len(recalls),
+        "recall": round(float(np.mean(recalls)), 4) if recalls else None, "faces": len(face_photo_idx),
+        "exact_ms_p50": round(float(np.median(exact_times)) * 1000, 3),
+        "fast_ms_p50": round(float(np.median(fast_times)) * 1000, 3),
+    }
+
+def ann_recall_check(num_queries=50, nprobe=None, noise=0.6, seed=0):
+    """Measures ANN recall and latency against exact search (see _recall_against_exact)."""
+    snapshot = get_index_snapshot()
+    if snapshot["ann"] is None:
+        if not ann_search_in_use(): return {"error": "ANN index is disabled (ANN_ENABLED off, or LARGE_GALLERY_STRATEGY is 'clusters')."}
+        return {"error": "ANN index is not built (gallery below ANN_MIN_FACES or still building)."}
+    result = _recall_against_exact(snapshot, lambda query: search_known_encodings(query, strategy="ann", nprobe=nprobe), num_queries, noise, seed)
+    return dict(result, nprobe=nprobe or ANN_NPROBE, nlist=len(snapshot["ann"]["centroids"]))
+
+def cluster_recall_check(num_queries=50, noise=0.6, seed=0):
+    """Measures identity-cluster search recall and latency against exact search."""
+    snapshot = get_index_snapshot()
+    if snapshot["cluster_centroids"] is None: return {"error": "No identity clusters (clustering disabled or gallery empty)."}
+    result = _recall_against_exact(snapshot, lambda query: search_known_encodings(query, strategy="clusters"), num_queries, noise, seed)
+    return dict(result, clusters=len(snapshot["cluster_centroids"]))
+
+# --- Query Cache ---
+def new_lru_cache(max_entries, ttl_seconds):
+    return {"entries": OrderedDict(), "lock": threading.Lock(), "max_entries": max_entries,
+            "ttl": ttl_seconds, "hits": 0, "misses": 0}
+
+def cache_get(cache, key):
+    """Returns the cached value, or None on a miss (expired entries are misses)."""
+    with cache["lock"]:
+        item = cache["entries"].get(key)
+        if item is not None and time.monotonic() - item[0] <= cache["ttl"]:
+            cache["entries"].move_to_end(key)
+            cache["hits"] += 1
+            return item[1]
+        if item is not None: del cache["entries"][key]
+        cache["misses"] += 1
+        return None
+
+def cache_put(cache, key, value):
+    with cache["lock"]:
+        cache["entries"][key] = (time.monotonic(), value)
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > cache["max_entries"]: cache["entries"].popitem(last=False)
+
+def cache_clear(cache):
+    with cache["lock"]: cache["entries"].clear()
+
+def cache_stats(cache):
+    with cache["lock"]:
+        lookups = cache["hits"] + cache["misses"]
+        return {"entries": len(cache["entries"]), "hits": cache["hits"], "misses": cache["misses"],
+                "hit_rate": round(cache["hits"] / lookups, 4) if lookups else None}
+
+# Selfie SHA-1 -> normalized embedding (False when no face was detected).
+EMBEDDING_CACHE = new_lru_cache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+# (GALLERY_VERSION, rounded embedding) -> (ranked matches, best identity cluster).
+RESULT_CACHE = new_lru_cache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+
+def cached_search(user_encoding_norm):
+    """search_known_encodings() plus best_identity_cluster(), memoized per gallery version."""
+    key = (GALLERY_VERSION, np.round(np.asarray(user_encoding_norm) / QUERY_CACHE_STEP).astype(np.int16).tobytes())
+    result = cache_get(RESULT_CACHE, key)
+    if result is None:
+        result = (search_known_encodings(user_encoding_norm), best_identity_cluster(user_encoding_norm))
+        cache_put(RESULT_CACHE, key, result)
+    return result
+
+# Paginated result sets: result_id -> [(image_path, score or None)]. Each set is
+# also saved under RESULT_SETS_DIR for later pages served by other processes.
+RESULT_SETS = new_lru_cache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+RESULT_SETS_PRUNED_AT = 0.0
+
+def photo_urls(image_path):
+    filename = os.path.basename(image_path)
+    urls = {name: url_for('serve_photo_derivative', size_name=name, filename=filename) for name in DERIVATIVE_SIZES}
+    return dict(urls, original=url_for('serve_event_photo', filename=filename), download=url_for('download_file', filename=filename))
+
+def store_result_set(ranked):
+    global RESULT_SETS_PRUNED_AT
+    result_id = uuid.uuid4().hex
+    cache_put(RESULT_SETS, result_id, ranked)
+    try: write_shared_state(RESULT_SETS_DIR, result_id, {"ranked": ranked})
+    except OSError as e: logger.warning(f"Could not save result set {result_id}: {e}")
+    if time.time() - RESULT_SETS_PRUNED_AT > 60: # Expired sets are swept at most once a minute.
+        RESULT_SETS_PRUNED_AT = time.time()
+        prune_shared_state(RESULT_SETS_DIR, max_age=QUERY_CACHE_TTL_SECONDS)
+    return result_id
+
+def load_result_set(result_id):
+    """A stored result set from this or any other server process, or None once expired."""
+    ranked = cache_get(RESULT_SETS, result_id)
+    if ranked is None:
+        state = read_shared_state(RESULT_SETS_DIR, result_id, max_age=QUERY_CACHE_TTL_SECONDS)
+        if state is None: return None
+        ranked = [(path, score) for path, score in state["ranked"]]
+        cache_put(RESULT_SETS, result_id, ranked)
+    return ranked
+
+def result_page(ranked, page, per_page, result_id=None):
+    """One page of ranked [(image_path, score)] as thumbnail URLs plus per-photo URL sets."""
+    per_page = max(1, min(int(per_page or RESULTS_PER_PAGE), MAX_RESULTS_PER_PAGE))
+    page = max(1, int(page or 1))
+    items = ranked[(page - 1) * per_page:page * per_page]
+    photos = [dict(photo_urls(path), score=None if score is None else round(score, 4)) for path, score in items]
+    has_more = page * per_page < len(ranked)
+    return {
+        "matches": [photo["thumb"] for photo in photos],
+        "photos": photos,
+        "page": page, "per_page": per_page, "total": len(ranked),
+        "result_id": result_id,
+        "next_page": url_for('result_set_page', result_id=result_id, page=page + 1, per_page=per_page) if has_more and result_id else None,
+        "download_all": url_for('download_result_set', result_id=result_id) if result_id else None,
+    }
+
+class _ZipStreamSink(io.RawIOBase):
+    """Write-only, unseekable file object collecting archive bytes until drained."""
+    def __init__(self): super().__init__(); self._chunks = []
+    def writable(self): return True
+    def write(self, data): self._chunks.append(bytes(data)); return len(data)
+    def drain(self):
+        data = b''.join(self._chunks); self._chunks.clear()
+        return data
+
+def stream_zip(image_paths, chunk_size=None):
+    """
+    Yields a ZIP archive of the given photos as it is built. Entries are stored
+    without recompression (JPEGs do not shrink), and because the sink is unseekable
+    zipfile writes sizes in data descriptors, so nothing is buffered beyond one
+    chunk and no temp file is needed.
+    """
+    chunk_size = chunk_size or ZIP_STREAM_CHUNK_SIZE
+    sink, names = _ZipStreamSink(), set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for image_path in image_paths:
+            name = os.path.basename(image_path)
+            if name in names: continue
+            try:
+                info = zipfile.ZipInfo.from_file(image_path, arcname=name)
+                with open(image_path, 'rb') as src, archive.open(info, 'w') as dst:
+                    for chunk in iter(lambda: src.read(chunk_size), b''):
+                        dst.write(chunk)
+                        yield sink.drain()
+            except OSError as e: logger.error(f"Bulk download: skipping {image_path}: {e}"); continue
+            names.add(name)
+            yield sink.drain()
+    yield sink.drain() # Central directory.
+
+def embed_selfie(image_bytes, timings=None):
+    """Decodes a selfie and returns its face encodings, or None if it cannot be decoded."""
+    timings = {} if timings is None else timings
+    with timed_stage(timings, "decode"): image_rgb = image_to_rgb(image_bytes)
+    if image_rgb is None: return None
+    return get_face_encodings_from_image(image_rgb, timings)
+
+def run_selfie_inference(image_bytes, timings=None):
+    """
+    Runs embed_selfie() on the bounded inference pool. Returns (encodings, error);
+    error is (message, status) when the pool is saturated or the inference times out.
+    """
+    global INFERENCE_EXECUTOR
+    if not INFERENCE_SLOTS.acquire(blocking=False):
+        return None, ("Server is busy. Please try again in a moment.", 503)
+    submitted_at = time.perf_counter()
+    def task():
+        # Own timings dict: after a timeout the caller stops reading while this still runs.
+        task_timings = {"inference_wait": time.perf_counter() - submitted_at}
+        return embed_selfie(image_bytes, task_timings), task_timings
+    try:
+        if INFERENCE_EXECUTOR is None: INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+        future = INFERENCE_EXECUTOR.submit(task)
+    except Exception: INFERENCE_SLOTS.release(); raise
+    future.add_done_callback(lambda _: INFERENCE_SLOTS.release())
+    try: encodings, task_timings = future.result(timeout=INFERENCE_TIMEOUT_SECONDS)
+    except FutureTimeoutError: return None, ("Face analysis timed out. Please try again.", 504)
+    if timings is not None: timings.update(task_timings)
+    return encodings, None
+
+def read_into_buffer(stream, length, max_bytes):
+    """
+    Reads length bytes from stream into one preallocated buffer (no intermediate
+    bytes objects) and returns a memoryview of it, or None if it is larger than max_bytes.
+    """
+    if length is None: # Chunked upload: size unknown up front.
+        data = stream.read(max_bytes + 1)
+        return None if len(data) > max_bytes else memoryview(data)
+    if length > max_bytes: return None
+    buffer = memoryview(bytearray(length))
+    if not hasattr(stream, 'readinto'): # SpooledTemporaryFile before Python 3.11
+        data = stream.read(length); buffer[:len(data)] = data; return buffer[:len(data)]
+    received = 0
+    while received < length:
+        count = stream.readinto(buffer[received:])
+        if not count: break
+        received += count
+    return buffer[:received]
+
+def read_request_body(max_bytes):
+    return read_into_buffer(request.stream, request.content_length, max_bytes)
+
+def read_selfie_upload(timings=None):
+    """
+    Returns (image bytes, page, per_page, error) for a selfie sent as a raw image
+    body, as a multipart "image" file, or as the legacy JSON {"image_data": <data URL>}.
+    """
+    page, per_page = request.args.get('page', 1, type=int), request.args.get('per_page', type=int)
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        image_bytes = read_request_body(MAX_SELFIE_BYTES)
+        if image_bytes is None: return None, page, per_page, ("Image is too large.", 413)
+        if not len(image_bytes): return None, page, per_page, ("No image data received", 400)
+        return image_bytes, page, per_page, None
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('image')
+        if file is None: return None, page, per_page, ("No image data received", 400)
+        stream = file.stream
+        length = stream.seek(0, io.SEEK_END); stream.seek(0)
+        image_bytes = read_into_buffer(stream, length, MAX_SELFIE_BYTES)
+        if image_bytes is None: return None, page, per_page, ("Image is too large.", 413)
+        return image_bytes, request.form.get('page', page, type=int), request.form.get('per_page', per_page, type=int), None
+    data = request.get_json()
+    if not data or 'image_data' not in data:
+        return None, page, per_page, ("No image data received", 400)
+    try:
+        _, encoded_data = data['image_data'].split(",", 1)
+        with timed_stage({} if timings is None else timings, "base64_decode"): image_bytes = base64.b64decode(encoded_data)
+    except Exception as e:
+        logger.warning(f"Error decoding base64 string: {e}")
+        return None, page, per_page, ("Invalid image data format provided", 400)
+    return image_bytes, data.get('page', 1), data.get('per_page'), None
+
+def send_cached_photo(directory, filename):
+    """Sends a photo with ETag/Last-Modified (304 on a conditional match) and long-lived cache headers."""
+    response = send_from_directory(directory, os.path.basename(filename), max_age=PHOTO_CACHE_MAX_AGE, conditional=True, etag=True)
+    response.cache_control.public = True
+    return response
 
 # --- Flask Routes ---
 @app.route('/')
@@ -196,6 +1878,9 @@ def photographer_upload_photos():
     if 'photos' not in request.files: return jsonify({"status": "error", "message": "No photo part"}), 400
     files = request.files.getlist('photos')
     if not files or all(f.filename == '' for f in files): return jsonify({"status": "error", "message": "No selected files"}), 400
+    if INGEST_QUEUE.qsize() + len(files) > INGEST_QUEUE_SIZE:
+        return jsonify({"status": "error", "message": "Processing queue is full. Please retry in a few minutes."}), 503
+    if not KNOWN_INDEXED_PATHS: load_known_encodings()
     uploaded_count, error_count, errors, newly_saved_paths = 0, 0, [], []
     for file in files:
         if file and allowed_file(file.filename):
@@ -203,205 +1888,240 @@ def photographer_upload_photos():
             save_path = os.path.join(EVENT_PHOTOS_DIR, original_filename) 
             try:
                 file.save(save_path)
-                uploaded_count += 1; newly_saved_paths.append(save_path)
-            except Exception as e: print(f"Error saving {original_filename}: {e}"); error_count +=1; errors.append(f"Save error for {original_filename}")
+                uploaded_count += 1
+                if save_path not in KNOWN_INDEXED_PATHS: newly_saved_paths.append(save_path)
+            except Exception as e: logger.error(f"Error saving {original_filename}: {e}"); error_count +=1; errors.append(f"Save error for {original_filename}")
         elif file.filename != '': error_count +=1; errors.append(f"File type not allowed: {file.filename}")
     if uploaded_count == 0: return jsonify({"status": "error", "message": f"No valid photos uploaded. Errors: {'; '.join(errors)}"}), 400
-    processing_details = "No new photos to process."
-    if newly_saved_paths:
-        print(f"Photographer upload: {uploaded_count} photos saved. Triggering specific processing...")
-        processing_details = process_specific_new_photos(newly_saved_paths)
-        load_known_encodings()
-    message = f"{uploaded_count} photo(s) uploaded."
+    job = enqueue_ingest_job(newly_saved_paths)
+    logger.info(f"Photographer upload: {uploaded_count} photos saved, {len(newly_saved_paths)} queued as job {job['job_id']}.")
+    message = f"{uploaded_count} photo(s) uploaded, {len(newly_saved_paths)} queued for processing."
     if error_count > 0: message += f" {error_count} photo(s) had errors: {'; '.join(errors)}."
-    return jsonify({"status": "success", "message": message, "details": processing_details})
+    return jsonify({"status": "success", "message": message, "job_id": job["job_id"],
+                    "status_url": url_for('ingest_job_status', job_id=job["job_id"])}), 202
+
+@app.route('/jobs/<job_id>')
+def ingest_job_status(job_id):
+    status = get_ingest_job_status(job_id)
+    if status is None: return jsonify({"status": "error", "message": "Unknown job ID."}), 404
+    return jsonify(status)
 
 # --- User Search Routes ---
 @app.route('/find_my_photos', methods=['POST'])
 def find_my_photos():
-    print("--- find_my_photos endpoint hit ---")
+    timings = {}
+    with timed_stage(timings, "total"): response = _find_my_photos(timings)
+    observe_stages("search", timings)
+    increment_counter("searches_total", status=response[1] if isinstance(response, tuple) else 200)
+    return response
+
+def _find_my_photos(timings):
+    logger.debug("--- find_my_photos endpoint hit ---")
     
     ### FIX ###: Added a master try...except block to catch all errors.
     try:
-        if not KNOWN_ENCODINGS_DATA:
+        if not KNOWN_PHOTO_PATHS:
             load_known_encodings()
-            if not KNOWN_ENCODINGS_DATA:
-                print("find_my_photos: KNOWN_ENCODINGS_DATA is empty even after reload.")
+            if not KNOWN_PHOTO_PATHS:
+                logger.warning("find_my_photos: gallery index is empty even after reload.")
                 return jsonify({"error": "Server is processing photos. Please try again in a moment.", "matches": []}), 503
 
-        data = request.get_json()
-        if not data or 'image_data' not in data:
-            return jsonify({"error": "No image data received"}), 400
+        with timed_stage(timings, "parse"): image_bytes, page, per_page, error = read_selfie_upload(timings)
+        if error: return jsonify({"error": error[0], "matches": []}), error[1]
 
-        try:
-            _, encoded_data = data['image_data'].split(",", 1)
-            image_bytes = base64.b64decode(encoded_data)
-        except Exception as e:
-            print(f"Error decoding base64 string: {e}")
-            return jsonify({"error": "Invalid image data format provided"}), 400
-        
-        uploaded_image_rgb = image_to_rgb(image_bytes)
-        if uploaded_image_rgb is None:
-            return jsonify({"error": "Could not process your image. Please ensure it's a clear photo."}), 400
-        
-        user_face_encodings = get_face_encodings_from_image(uploaded_image_rgb)
-        
-        if not user_face_encodings:
+        # Re-sent selfies skip decoding and the face model entirely.
+        image_key = hashlib.sha1(image_bytes).hexdigest()
+        user_encoding_norm = cache_get(EMBEDDING_CACHE, image_key)
+        if user_encoding_norm is False:
             return jsonify({"matches": [], "message": "No face detected in your photo. Please try again."})
-        
-        user_encoding = user_face_encodings[0]
-        
-        ### FIX ###: Check for zero-norm before dividing.
-        user_norm = np.linalg.norm(user_encoding)
-        if user_norm == 0:
-            print("Error: User face encoding resulted in a zero-vector.")
-            return jsonify({"error": "Could not generate a valid face profile from your photo.", "matches": []}), 400
-        user_encoding_norm = user_encoding / user_norm
-
-        matched_photos_paths = set()
-        print(f"Comparing user face against {len(KNOWN_ENCODINGS_DATA)} known photos.")
-        for item in KNOWN_ENCODINGS_DATA:
-            if not item.get("encodings"):
-                continue
-            
-            for known_encoding in item["encodings"]:
-                ### FIX ###: Add the same defensive check for the known encodings.
-                known_norm = np.linalg.norm(known_encoding)
-                if known_norm == 0:
-                    continue # Skip this invalid encoding
-                    
-                known_encoding_norm = known_encoding / known_norm
-                
-                similarity = np.dot(user_encoding_norm, known_encoding_norm)
-                
-                if similarity > SIMILARITY_THRESHOLD:
-                    print(f"Match found! Photo: {item['image_path']}, Similarity: {similarity:.4f}")
-                    matched_photos_paths.add(f"/event_photos/{os.path.basename(item['image_path'])}")
-                    break
-        
-        if not matched_photos_paths:
+        if user_encoding_norm is None:
+            user_face_encodings, error = run_selfie_inference(image_bytes, timings)
+            if error: return jsonify({"error": error[0], "matches": []}), error[1]
+            if user_face_encodings is None:
+                return jsonify({"error": "Could not process your image. Please ensure it's a clear photo."}), 400
+
+            if not user_face_encodings:
+                cache_put(EMBEDDING_CACHE, image_key, False)
+                return jsonify({"matches": [], "message": "No face detected in your photo. Please try again."})
+
+            user_encoding = user_face_encodings[0]
+
+            ### FIX ###: Check for zero-norm before dividing.
+            user_norm = np.linalg.norm(user_encoding)
+            if user_norm == 0:
+                logger.warning("User face encoding resulted in a zero-vector.")
+                return jsonify({"error": "Could not generate a valid face profile from your photo.", "matches": []}), 400
+            user_encoding_norm = user_encoding / user_norm
+            cache_put(EMBEDDING_CACHE, image_key, user_encoding_norm)
+
+        logger.debug("Comparing user face against %d known faces.", len(KNOWN_FACE_PHOTO_IDX))
+        with timed_stage(timings, "search"): ranked_matches, cluster_id = cached_search(user_encoding_norm)
+
+        if not ranked_matches:
             return jsonify({"matches": [], "message": "No photos found matching your face."})
 
-        return jsonify({"matches": sorted(list(matched_photos_paths))})
+        with timed_stage(timings, "serialize"):
+            result_id = store_result_set(ranked_matches)
+            response = result_page(ranked_matches, page, per_page, result_id)
+            response["scores"] = [photo["score"] for photo in response["photos"]]
+            response["cluster_id"] = cluster_id
+            return jsonify(response)
 
     except Exception as e:
         # This block will catch any unexpected error, log it, and send a clean JSON response.
-        print(f"FATAL ERROR in /find_my_photos: {e}")
-        traceback.print_exc() # This will print the detailed error to your server console
+        logger.exception(f"FATAL ERROR in /find_my_photos: {e}")
         return jsonify({"error": "An unexpected server error occurred. Please contact support.", "matches": []}), 500
-    ### INSIGHTFACE UPDATE ###
-    # Get user's face encoding using the new model.
-    user_face_encodings = get_face_encodings_from_image(uploaded_image_rgb)
-    
-    if not user_face_encodings:
-        return jsonify({"matches": [], "message": "No face detected in your photo. Please try again."})
-    
-    # We only use the first detected face from the user's selfie.
-    user_encoding = user_face_encodings[0]
-    # Normalize the user's encoding for cosine similarity calculation.
-    user_encoding_norm = user_encoding / np.linalg.norm(user_encoding)
-
-    matched_photos_paths = set()
-    print(f"Comparing user face against {len(KNOWN_ENCODINGS_DATA)} known photos.")
-    for item in KNOWN_ENCODINGS_DATA:
-        if not item.get("encodings"): continue
-        
-        # ### INSIGHTFACE UPDATE ###
-        # # The core comparison logic is now based on cosine similarity.
-        for known_encoding in item["encodings"]:
-            # Normalize each known encoding
-            known_encoding_norm = known_encoding / np.linalg.norm(known_encoding)
-            
-            # Calculate cosine similarity
-            similarity = np.dot(user_encoding_norm, known_encoding_norm)
-            
-            if similarity > SIMILARITY_THRESHOLD:
-                print(f"Match found! Photo: {item['image_path']}, Similarity: {similarity:.4f}")
-                matched_photos_paths.add(f"/event_photos/{os.path.basename(item['image_path'])}")
-                # Once a match is found in a photo, we don't need to check other faces in it
-                break 
-    
-    if not matched_photos_paths:
-        return jsonify({"matches": [], "message": "No photos found matching your face."})
 
-    return jsonify({"matches": sorted(list(matched_photos_paths))})
 
+@app.route('/clusters/<int:cluster_id>')
+def cluster_photos(cluster_id):
+    """All photos of one identity cluster, without re-running the face model."""
+    paths = identity_cluster_photos(cluster_id)
+    if paths is None: return jsonify({"error": "Unknown cluster ID.", "matches": []}), 404
+    ranked = [(path, None) for path in paths]
+    response = result_page(ranked, request.args.get('page', 1, type=int), request.args.get('per_page', type=int), store_result_set(ranked))
+    return jsonify(dict(response, cluster_id=cluster_id))
+
+@app.route('/results/<result_id>')
+def result_set_page(result_id):
+    """Further pages of an earlier search, without repeating it."""
+    ranked = load_result_set(result_id)
+    if ranked is None: return jsonify({"error": "Results expired. Please search again.", "matches": []}), 404
+    return jsonify(result_page(ranked, request.args.get('page', 1, type=int), request.args.get('per_page', type=int), result_id))
+
+
+@app.route('/results/<result_id>/download')
+def download_result_set(result_id):
+    """All photos of a result set as one streamed ZIP of the originals."""
+    ranked = load_result_set(result_id)
+    if ranked is None: return jsonify({"error": "Results expired. Please search again."}), 404
+    image_paths = [os.path.join(EVENT_PHOTOS_DIR, os.path.basename(path)) for path, _ in ranked]
+    return Response(stream_zip(image_paths), mimetype='application/zip',
+                    headers={"Content-Disposition": f'attachment; filename="my-photos-{result_id[:8]}.zip"'})
 
 @app.route('/event_photos/<path:filename>')
 def serve_event_photo(filename):
-    return send_from_directory(EVENT_PHOTOS_DIR, os.path.basename(filename))
+    return send_cached_photo(EVENT_PHOTOS_DIR, filename)
+
+@app.route('/photos/<size_name>/<path:filename>')
+def serve_photo_derivative(size_name, filename):
+    """Thumbnail/preview of an event photo, generated on first request if ingest did not write it."""
+    image_path = os.path.join(EVENT_PHOTOS_DIR, os.path.basename(filename))
+    if size_name not in DERIVATIVE_SIZES or not allowed_file(filename) or not os.path.isfile(image_path):
+        return jsonify({"error": "File not found."}), 404
+    if not _derivative_is_current(image_path, size_name):
+        try: generated = write_photo_derivatives(image_path, [size_name])
+        except Exception as e: logger.error(f"Could not write {size_name} for {image_path}: {e}"); generated = False
+        if not generated: return send_cached_photo(EVENT_PHOTOS_DIR, filename)
+    return send_cached_photo(os.path.join(DERIVATIVES_DIR, size_name), filename)
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
     path_to_file = os.path.join(EVENT_PHOTOS_DIR, os.path.basename(filename))
     if os.path.exists(path_to_file) and os.path.isfile(path_to_file):
         try: return send_file(path_to_file, as_attachment=True)
-        except Exception as e: print(f"Error sending file {filename}: {e}"); return "Error.", 500
+        except Exception as e: logger.error(f"Error sending file {filename}: {e}"); return "Error.", 500
     return "File not found.", 404
 
 # --- Admin Route ---
 @app.route('/admin/process_photos', methods=['GET', 'POST']) 
 def trigger_preprocessing():
-    print("Admin request to process all photos received.")
+    logger.info("Admin request to process all photos received.")
     try:
         # NOTE: If you run this, all old encodings will be replaced with new,
         # higher quality InsightFace encodings. This is required.
-        result_message = preprocess_event_photos_on_demand()
+        restart = request.args.get('restart', '').lower() in ('1', 'true', 'yes')
+        result_message = preprocess_event_photos_on_demand(restart=restart)
+        if result_message == RESCAN_ALREADY_RUNNING: return jsonify({"status": "error", "message": result_message}), 409
         load_known_encodings() 
         return jsonify({"status": "success", "message": "Full reprocessing finished.", "details": result_message})
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error during full reprocessing.")
         return jsonify({"status": "error", "message": "Error during full reprocessing.", "details": str(e)}), 500
 
+@app.route('/admin/ann_recall')
+def ann_recall():
+    result = ann_recall_check(num_queries=request.args.get('queries', 50, type=int), nprobe=request.args.get('nprobe', type=int))
+    return jsonify(result), (409 if "error" in result else 200)
+
+@app.route('/admin/cluster_recall')
+def cluster_recall():
+    result = cluster_recall_check(num_queries=request.args.get('queries', 50, type=int))
+    return jsonify(result), (409 if "error" in result else 200)
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/cache_stats')
+def query_cache_stats():
+    return jsonify({"gallery_version": GALLERY_VERSION, "embeddings": cache_stats(EMBEDDING_CACHE), "results": cache_stats(RESULT_CACHE)})
+
+# --- Production Entry Point ---
+def create_app():
+    """
+    App factory for pre-fork servers, called once in every worker process:
+        gunicorn -c gunicorn.conf.py 'app:create_app()'
+    Each worker loads and warms up its own model. The face index is memory-mapped,
+    so all workers share one copy through the page cache, and a watcher thread
+    applies gallery changes made by the other workers.
+    """
+    global FACE_APP
+    if FACE_APP is None:
+        logger.info(f"Initializing InsightFace model ({MODEL_NAME}) in worker {os.getpid()}...")
+        FACE_APP = create_face_app()
+        warm_up_face_app(FACE_APP)
+    with face_index_file_lock():
+        if not os.path.exists(FACE_INDEX_MANIFEST) and os.path.exists(ENCODINGS_FILE): migrate_json_encodings()
+    if not os.path.exists(FACE_INDEX_MANIFEST):
+        logger.warning(f"{FACE_INDEX_MANIFEST} not found. Build it with /admin/process_photos or by running app.py once.")
+    refresh_index_if_changed()
+    if IDENTITY_CLUSTERS is None: load_known_encodings()
+    start_index_watcher()
+    return app
+
 # --- Main Application Execution ---
 # --- Main Application Execution ---
 if __name__ == '__main__':
     # Initialize the FaceAnalysis model when the app starts.
     # This is crucial for performance as the model is loaded into memory only once.
-    print("Initializing InsightFace model (buffalo_l)... This may take a moment.")
+    logger.info(f"Initializing InsightFace model ({MODEL_NAME})... This may take a moment.")
     try:
-        # For CPU usage
-        FACE_APP = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-        
-        # --- UNCOMMENT FOR GPU USAGE ---
-        # If you have a compatible NVIDIA GPU and have installed 'onnxruntime-gpu', use this instead:
-        # print("Attempting to use CUDA (GPU) for InsightFace.")
-        # FACE_APP = FaceAnalysis(name='buffalo_l', providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-        
-        FACE_APP.prepare(ctx_id=0, det_size=(640, 640))
-        print("InsightFace model initialized successfully.")
+        FACE_APP = create_face_app()
+        logger.info("InsightFace model initialized successfully.")
     except Exception as e:
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print(f"FATAL ERROR: Could not initialize InsightFace model: {e}")
-        print("Please ensure 'insightface' and 'onnxruntime' (or 'onnxruntime-gpu') are installed correctly.")
-        print("pip install insightface==0.7.3 onnxruntime")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        logger.critical("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        logger.critical(f"FATAL ERROR: Could not initialize InsightFace model: {e}")
+        logger.critical("Please ensure 'insightface' and 'onnxruntime' (or 'onnxruntime-gpu') are installed correctly.")
+        logger.critical("pip install insightface==0.7.3 onnxruntime")
+        logger.critical("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         # Exit the application if the core component fails to load.
         exit()
 
 
     # IMPORTANT: This block handles the critical step of ensuring your encodings
     # match the model you are using (InsightFace).
-    if not os.path.exists(ENCODINGS_FILE) and os.path.exists(EVENT_PHOTOS_DIR) and len(os.listdir(EVENT_PHOTOS_DIR)) > 0:
-        print(f"'{ENCODINGS_FILE}' not found. Starting initial full preprocessing with InsightFace...")
-        print("This will generate new 512-dimension encodings for all photos.")
+    if not os.path.exists(FACE_INDEX_MANIFEST) and os.path.exists(ENCODINGS_FILE):
+        migrate_json_encodings()
+    if not os.path.exists(FACE_INDEX_MANIFEST) and os.path.exists(EVENT_PHOTOS_DIR) and len(os.listdir(EVENT_PHOTOS_DIR)) > 0:
+        logger.info(f"'{FACE_INDEX_MANIFEST}' not found. Starting initial full preprocessing with InsightFace...")
+        logger.info("This will generate new 512-dimension encodings for all photos.")
         try:
             preprocess_event_photos_on_demand()
         except Exception as e:
-            print(f"Error during initial full preprocessing: {e}")
-            traceback.print_exc()
+            logger.exception(f"Error during initial full preprocessing: {e}")
 
     # Always load whatever encodings are available after the potential preprocessing step.
     load_known_encodings()
 
-    if not KNOWN_ENCODINGS_DATA and os.path.exists(EVENT_PHOTOS_DIR) and len(os.listdir(EVENT_PHOTOS_DIR)) > 0:
-        print("-----------------------------------------------------------------------------------")
-        print("WARNING: No face encodings were loaded, but photos exist in the event directory.")
-        print(f"This could mean the '{ENCODINGS_FILE}' is empty or corrupted.")
-        print("You may need to manually delete the file and restart, or hit the /admin/process_photos endpoint.")
-        print("-----------------------------------------------------------------------------------")
+    if not KNOWN_PHOTO_PATHS and os.path.exists(EVENT_PHOTOS_DIR) and len(os.listdir(EVENT_PHOTOS_DIR)) > 0:
+        logger.warning("-----------------------------------------------------------------------------------")
+        logger.warning("WARNING: No face encodings were loaded, but photos exist in the event directory.")
+        logger.warning(f"This could mean the face index in '{FACE_INDEX_DIR}' is empty or corrupted.")
+        logger.warning("You may need to manually delete the file and restart, or hit the /admin/process_photos endpoint.")
+        logger.warning("-----------------------------------------------------------------------------------")
 
-    print("Starting Flask server...")
+    logger.info("Starting Flask server...")
     # The 'debug=True' setting is great for development, as it provides detailed error pages
     # and automatically reloads the server when you save changes.
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
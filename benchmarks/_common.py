@@ -0,0 +1,21 @@
+"""Helpers shared by the benchmark scripts (imported as a sibling module)."""
+import resource
+import sys
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def synthetic_jpeg(path, width, height, seed=0):
+    """Writes a width x height JPEG to path and returns the path."""
+    import cv2
+    import numpy as np
+    # Smooth gradients plus noise compress like a real photo rather than pure noise.
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.dstack([(x * 255 // width), (y * 255 // height), ((x + y) * 255 // (width + height))]).astype(np.uint8)
+    image = cv2.add(image, np.random.default_rng(seed).integers(0, 24, image.shape, dtype=np.uint8))
+    cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    return path
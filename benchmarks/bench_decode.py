@@ -0,0 +1,95 @@
+"""
+Benchmarks the ingest decode path: the legacy full decode (cv2.imread + resize +
+separate BGR->RGB copy) against image_to_rgb(..., for_preprocessing=True), which
+uses a DCT-scaled reduced decode and an in-place color conversion.
+
+Each mode runs in its own subprocess so peak RSS is measured in isolation (the
+synthetic photo is generated in a subprocess too: Linux children inherit the
+parent's RSS high-water mark).
+
+    python benchmarks/bench_decode.py                  # synthetic 24 MP JPEG
+    python benchmarks/bench_decode.py photo1.jpg ...   # your own camera files
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import peak_rss_mb, synthetic_jpeg
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_mode(mode, paths, repeats):
+    """Runs inside the child process; prints one JSON line with the measurements."""
+    sys.path.insert(0, REPO_DIR)
+    import cv2
+    import app
+
+    def legacy(path):
+        img_bgr = cv2.imread(path)
+        img_bgr = app.resize_image_if_needed(img_bgr, app.MAX_PREPROCESSING_SIZE)
+        return cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+
+    def reduced(path):
+        return app.image_to_rgb(path, for_preprocessing=True)
+
+    decode = legacy if mode == "legacy" else reduced
+    baseline_mb = peak_rss_mb()
+    timings, shape = [], None
+    for _ in range(repeats):
+        for path in paths:
+            start = time.perf_counter()
+            shape = decode(path).shape
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(json.dumps({
+        "mode": mode,
+        "photos_decoded": len(timings),
+        "output_shape": list(shape),
+        "median_ms": round(timings[len(timings) // 2] * 1000, 2),
+        "p90_ms": round(timings[int(len(timings) * 0.9)] * 1000, 2),
+        "peak_rss_increase_mb": round(peak_rss_mb() - baseline_mb, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("photos", nargs="*", help="JPEG files to decode (default: one synthetic 6000x4000 JPEG)")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print raw JSON results only")
+    parser.add_argument("--child", choices=["legacy", "reduced", "synthetic"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == "synthetic":
+        print(synthetic_jpeg(os.path.join(args.photos[0], "synthetic_6000x4000.jpg"), 6000, 4000))
+        return
+    if args.child:
+        _run_mode(args.child, args.photos, args.repeats)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        photos = [os.path.abspath(p) for p in args.photos]
+        if not photos:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "synthetic", tmp_dir],
+                                    check=True, capture_output=True, text=True).stdout
+            photos = [output.strip().splitlines()[-1]]
+        results = []
+        for mode in ("legacy", "reduced"):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, "--repeats", str(args.repeats), *photos],
+                                    cwd=tmp_dir, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<10}{'median ms':>12}{'p90 ms':>10}{'peak RSS +MB':>14}  output")
+    for r in results:
+        print(f"{r['mode']:<10}{r['median_ms']:>12}{r['p90_ms']:>10}{r['peak_rss_increase_mb']:>14}  {r['output_shape']}")
+
+
+if __name__ == "__main__":
+    main()
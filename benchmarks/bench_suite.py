@@ -0,0 +1,251 @@
+"""
+End-to-end benchmark suite on synthetic data; no InsightFace model needed.
+
+For each gallery size a synthetic face index is built (random 512-d identity
+vectors, 1-3 noisy faces per photo) and then measured in a fresh subprocess:
+index load time, peak RSS, search latency percentiles per strategy, ingest
+photos/s for synthetic JPEGs of several sizes, and /find_my_photos throughput
+through the Flask test client (cold: caches cleared per request, and cached).
+
+get_face_encodings_from_image is replaced by a stub that maps each image to a
+gallery identity (plus noise), so searches return realistic match lists. Pass
+--embedder module:function to plug in another stub; it receives an RGB image
+and returns a list of embeddings, like the real function.
+
+    python benchmarks/bench_suite.py                          # 1k, 100k and 1M faces
+    python benchmarks/bench_suite.py --faces 1000,100000 --output run.json
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import peak_rss_mb, synthetic_jpeg
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FACES_PER_IDENTITY = 20
+FACE_NOISE = 0.7 # Per-dimension noise relative to the unit-variance identity vectors.
+
+
+def _percentiles_ms(timings):
+    import numpy as np
+    if not timings: return None
+    p50, p90, p99 = np.percentile(np.asarray(timings) * 1000, [50, 90, 99])
+    return {"p50": round(float(p50), 3), "p90": round(float(p90), 3), "p99": round(float(p99), 3)}
+
+
+def _identities(num_faces, seed):
+    import numpy as np
+    return np.random.default_rng(seed).standard_normal((max(1, num_faces // FACES_PER_IDENTITY), 512)).astype(np.float32)
+
+
+def make_stub_embedder(identities, delay_ms=0.0):
+    """Deterministic stand-in for get_face_encodings_from_image: image pixels pick an identity."""
+    import numpy as np
+
+    def stub(image_rgb, timings=None):
+        digest = hashlib.sha1(np.ascontiguousarray(image_rgb[::8, ::8]).tobytes()).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+        identity = identities[rng.integers(len(identities))]
+        if delay_ms: time.sleep(delay_ms / 1000) # Simulated model time (releases the GIL like ONNX Runtime).
+        return [identity + rng.standard_normal(identity.shape).astype(np.float32) * FACE_NOISE]
+    return stub
+
+
+def _load_embedder(spec, identities, delay_ms):
+    if spec == "stub": return make_stub_embedder(identities, delay_ms)
+    module_name, _, attr = spec.partition(":")
+    embedder = getattr(importlib.import_module(module_name), attr)
+    return lambda image_rgb, timings=None: embedder(image_rgb)
+
+
+def _build_gallery(num_faces, seed, chunk_size=65536):
+    """Runs in a child with cwd = gallery dir: writes face_index/ for num_faces synthetic faces."""
+    sys.path.insert(0, REPO_DIR)
+    import numpy as np
+    import app
+
+    identities = _identities(num_faces, seed)
+    rng = np.random.default_rng(seed + 1)
+    faces_per_photo = rng.integers(1, 4, size=num_faces) # Over-generated; trimmed to num_faces below.
+    photo_ends = np.cumsum(faces_per_photo)
+    num_photos = int(np.searchsorted(photo_ends, num_faces)) + 1
+    faces_per_photo = faces_per_photo[:num_photos]
+    faces_per_photo[-1] -= int(photo_ends[num_photos - 1]) - num_faces
+    face_identity = rng.integers(len(identities), size=num_faces)
+    # The matrix is generated in chunks into a memory-mapped file, so building 1M faces stays within a few GB.
+    os.makedirs("build", exist_ok=True)
+    embeddings = np.lib.format.open_memmap(os.path.join("build", "embeddings.npy"), mode='w+', dtype=np.float32, shape=(num_faces, 512))
+    for start in range(0, num_faces, chunk_size):
+        rows = face_identity[start:start + chunk_size]
+        chunk = identities[rows] + rng.standard_normal((len(rows), 512)).astype(np.float32) * FACE_NOISE
+        embeddings[start:start + len(rows)] = app.normalize_embeddings(chunk)[0]
+    # Synthetic identities double as cluster ids, so no clustering pass is needed.
+    photos, row = [], 0
+    for i, count in enumerate(faces_per_photo.tolist()):
+        photos.append({"image_path": os.path.join(app.EVENT_PHOTOS_DIR, f"photo_{i:07d}.jpg"), "num_faces": count,
+                       "cluster_ids": [int(c) for c in face_identity[row:row + count]]})
+        row += count
+    start = time.perf_counter()
+    app.write_face_index(photos, embeddings)
+    print(json.dumps({"photos": len(photos), "faces": num_faces, "identities": len(identities),
+                      "write_index_s": round(time.perf_counter() - start, 3)}))
+
+
+def _measure(args, build_info, ingest_photos):
+    """Runs in a child with cwd = gallery dir: loads the index and measures search, ingest and HTTP."""
+    sys.path.insert(0, REPO_DIR)
+    import numpy as np
+    import app
+
+    app.ANN_ENABLED = args.ann
+    if args.ann: app.LARGE_GALLERY_STRATEGY = "ann"
+    app.INDEX_PRECISION = args.precision
+    app.INGEST_WORKERS = 0
+    identities = _identities(build_info["faces"], args.seed)
+    app.get_face_encodings_from_image = _load_embedder(args.embedder, identities, args.stub_ms)
+    result = dict(build_info, precision=args.precision)
+
+    baseline_mb = peak_rss_mb()
+    start = time.perf_counter()
+    app.load_known_encodings()
+    result["load_s"] = round(time.perf_counter() - start, 3)
+    result["load_rss_increase_mb"] = round(peak_rss_mb() - baseline_mb, 1)
+    if args.ann and build_info["faces"] >= app.ANN_MIN_FACES:
+        start = time.perf_counter()
+        while app.ANN_INDEX is None and time.perf_counter() - start < args.ann_timeout: time.sleep(0.1)
+        result["ann_build_s"] = round(time.perf_counter() - start, 3) if app.ANN_INDEX is not None else None
+
+    # Queries: noisy copies of random gallery identities, like a new selfie of a guest.
+    rng = np.random.default_rng(args.seed + 2)
+    queries = identities[rng.integers(len(identities), size=args.queries)]
+    queries = app.normalize_embeddings(queries + rng.standard_normal(queries.shape).astype(np.float32) * FACE_NOISE)[0]
+    strategies = ["exact", "auto"] + (["clusters"] if app.CLUSTERING_ENABLED else []) + (["ann"] if app.ANN_INDEX is not None else [])
+    result["search_ms"], result["matches_per_query"] = {}, None
+    for strategy in strategies:
+        timings, match_counts = [], []
+        for query in queries:
+            start = time.perf_counter()
+            match_counts.append(len(app.search_known_encodings(query, strategy=strategy)))
+            timings.append(time.perf_counter() - start)
+        result["search_ms"][strategy] = _percentiles_ms(timings)
+        if strategy == "exact": result["matches_per_query"] = round(float(np.mean(match_counts)), 2)
+
+    # Ingest: decode, embed (stub), derivatives and live index append per photo, in-process.
+    result["ingest"] = {}
+    for size, paths in ingest_photos.items():
+        start = time.perf_counter()
+        for path in paths:
+            _, encodings, error, fingerprint, timings = app.embed_photo_for_ingest(path)
+            app._finish_ingest_file(None, path, encodings, error, fingerprint, timings)
+        elapsed = time.perf_counter() - start
+        result["ingest"][size] = {"photos": len(paths), "photos_per_s": round(len(paths) / elapsed, 2) if elapsed else None}
+
+    # HTTP: raw JPEG selfie uploads through the full /find_my_photos request path.
+    client = app.app.test_client()
+    selfies = []
+    for i in range(8):
+        path = synthetic_jpeg(os.path.join("build", f"selfie_{i}.jpg"), 640, 480, seed=1000 + i)
+        with open(path, 'rb') as f: selfies.append(f.read())
+    result["http"] = {}
+    for mode in ("cold", "cached"):
+        timings, statuses = [], {}
+        for i in range(args.requests):
+            if mode == "cold": app.cache_clear(app.EMBEDDING_CACHE); app.cache_clear(app.RESULT_CACHE)
+            start = time.perf_counter()
+            response = client.post('/find_my_photos', data=selfies[i % len(selfies)], content_type='image/jpeg')
+            timings.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        result["http"][mode] = {"requests_per_s": round(len(timings) / sum(timings), 2), "latency_ms": _percentiles_ms(timings),
+                                "status_codes": {str(code): count for code, count in statuses.items()}}
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    print(json.dumps(result))
+
+
+def _generate_ingest_photos(directory, sizes, count):
+    photos = {}
+    for size in sizes:
+        width, height = (int(v) for v in size.split("x"))
+        photos[size] = [synthetic_jpeg(os.path.join(directory, f"ingest_{size}_{i}.jpg"), width, height, seed=i) for i in range(count)]
+    return photos
+
+
+def _git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def _run_child(args, role, cwd, extra):
+    command = [sys.executable, os.path.abspath(__file__), "--child", role, "--seed", str(args.seed), *extra]
+    output = subprocess.run(command, cwd=cwd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--faces", default="1000,100000,1000000", help="comma-separated gallery sizes (faces)")
+    parser.add_argument("--queries", type=int, default=200, help="searches per strategy")
+    parser.add_argument("--requests", type=int, default=100, help="HTTP requests per mode")
+    parser.add_argument("--ingest-sizes", default="640x480,2000x1500,6000x4000", help="synthetic JPEG sizes for the ingest benchmark")
+    parser.add_argument("--ingest-photos", type=int, default=5, help="photos per ingest size")
+    parser.add_argument("--embedder", default="stub", help="'stub' or module:function replacing get_face_encodings_from_image")
+    parser.add_argument("--stub-ms", type=float, default=0.0, help="simulated model time per image for the default stub")
+    parser.add_argument("--precision", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--ann", action="store_true", help="build the IVF index and prefer it over cluster search (slow for large galleries)")
+    parser.add_argument("--ann-timeout", type=float, default=1800)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--json", action="store_true", help="print raw JSON results only")
+    parser.add_argument("--child", choices=["photos", "build", "measure"], help=argparse.SUPPRESS)
+    parser.add_argument("--child-args", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == "photos":
+        directory, sizes, count = json.loads(args.child_args)
+        print(json.dumps(_generate_ingest_photos(directory, sizes, count)))
+        return
+    if args.child == "build":
+        _build_gallery(int(args.child_args), args.seed)
+        return
+    if args.child == "measure":
+        child_args = json.loads(args.child_args)
+        _measure(argparse.Namespace(**child_args["options"], seed=args.seed), child_args["build"], child_args["ingest_photos"])
+        return
+
+    options = {"queries": args.queries, "requests": args.requests, "embedder": args.embedder, "stub_ms": args.stub_ms,
+               "precision": args.precision, "ann": args.ann, "ann_timeout": args.ann_timeout}
+    run = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git_commit": _git_commit(), "python": platform.python_version(),
+           "platform": platform.platform(), "cpu_count": os.cpu_count(), "options": dict(options, ingest_sizes=args.ingest_sizes,
+           ingest_photos=args.ingest_photos, seed=args.seed), "galleries": []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Generated in a child too: Linux children inherit the parent's RSS high-water mark.
+        ingest_photos = _run_child(args, "photos", tmp_dir, ["--child-args", json.dumps([tmp_dir, args.ingest_sizes.split(","), args.ingest_photos])])
+        for num_faces in (int(v) for v in args.faces.split(",")):
+            gallery_dir = os.path.join(tmp_dir, f"gallery_{num_faces}")
+            os.makedirs(gallery_dir)
+            if not args.json: print(f"Benchmarking {num_faces} faces...", file=sys.stderr)
+            # Building and measuring run in separate processes so peak RSS only reflects serving.
+            build_info = _run_child(args, "build", gallery_dir, ["--child-args", str(num_faces)])
+            child_args = {"options": options, "build": build_info, "ingest_photos": ingest_photos}
+            run["galleries"].append(_run_child(args, "measure", gallery_dir, ["--child-args", json.dumps(child_args)]))
+
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(run, f, indent=2)
+    if args.json:
+        print(json.dumps(run, indent=2))
+        return
+    print(f"{'faces':>9}{'load s':>8}{'RSS MB':>8}{'exact p50':>11}{'auto p50':>10}{'auto p99':>10}{'HTTP cold/s':>13}{'HTTP cached/s':>15}  ingest photos/s")
+    for g in run["galleries"]:
+        ingest = ", ".join(f"{size}: {r['photos_per_s']}" for size, r in g["ingest"].items())
+        print(f"{g['faces']:>9}{g['load_s']:>8}{g['peak_rss_mb']:>8}{g['search_ms']['exact']['p50']:>11}{g['search_ms']['auto']['p50']:>10}"
+              f"{g['search_ms']['auto']['p99']:>10}{g['http']['cold']['requests_per_s']:>13}{g['http']['cached']['requests_per_s']:>15}  {ingest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# Production server settings. Run with:
+#     gunicorn -c gunicorn.conf.py 'app:create_app()'
+import os
+
+bind = os.environ.get("SNAPTRACE_BIND", "0.0.0.0:5000")
+# Each worker holds its own InsightFace model (a few hundred MB); the face index
+# itself is memory-mapped and shared between workers through the page cache.
+workers = int(os.environ.get("SNAPTRACE_WORKERS", 2))
+# Request threads only parse, rank and send files; face analysis runs on the
+# bounded per-worker inference pool (INFERENCE_THREADS in app.py).
+worker_class = "gthread"
+threads = int(os.environ.get("SNAPTRACE_THREADS", 8))
+# The model must be created after fork (ONNX Runtime thread pools do not survive
+# fork), so the app factory runs in every worker rather than in the master.
+preload_app = False
+timeout = 120
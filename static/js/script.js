@@ -5,7 +5,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const resultsGrid = document.getElementById('resultsGrid'); // Updated ID
     const statusMessageDiv = document.getElementById('statusMessage'); // Updated ID
     const resultsContainer = document.getElementById('results-container');
+    const loadMoreButton = document.getElementById('loadMoreButton');
+    const downloadAllLink = document.getElementById('downloadAllLink');
 
+    const SELFIE_MAX_SIDE = 640; // Matches the server's det_size.
     let stream;
 
     async function setStatus(message, type = 'info') {
@@ -24,6 +27,56 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Results arrive a page at a time as thumbnails; the full-size file is only fetched on download.
+    function renderPhotos(data) {
+        data.photos.forEach(photo => {
+            const photoCardDiv = document.createElement('div'); // Changed class name
+            photoCardDiv.classList.add('photo-card'); // Changed class name
+
+            const previewLink = document.createElement('a');
+            previewLink.href = photo.preview;
+            previewLink.target = '_blank';
+            const img = document.createElement('img');
+            img.src = photo.thumb; 
+            img.alt = "Matched photo";
+            img.loading = "lazy"; // Lazy load images
+            previewLink.appendChild(img);
+
+            const downloadLink = document.createElement('a');
+            const filename = photo.download.split('/').pop();
+            downloadLink.href = photo.download;
+            downloadLink.textContent = `Download`;
+            downloadLink.classList.add('download-link');
+            downloadLink.setAttribute('download', decodeURIComponent(filename)); 
+            photoCardDiv.appendChild(previewLink);
+            photoCardDiv.appendChild(downloadLink);
+            resultsGrid.appendChild(photoCardDiv);
+        });
+        if (data.download_all) {
+            downloadAllLink.href = data.download_all;
+            downloadAllLink.style.display = 'inline-block';
+        }
+        loadMoreButton.style.display = data.next_page ? 'block' : 'none';
+        loadMoreButton.dataset.nextPage = data.next_page || '';
+    }
+
+    loadMoreButton.addEventListener('click', async () => {
+        const nextPage = loadMoreButton.dataset.nextPage;
+        if (!nextPage) return;
+        loadMoreButton.disabled = true;
+        try {
+            const response = await fetch(nextPage);
+            const data = await response.json();
+            if (!response.ok) { setStatus(data.error || `Server error (${response.status}).`, 'error'); return; }
+            renderPhotos(data);
+        } catch (error) {
+            console.error('Error loading more photos:', error);
+            setStatus(`Client-side error: ${error.message}.`, 'error');
+        } finally {
+            loadMoreButton.disabled = false;
+        }
+    });
+
     captureButton.addEventListener('click', async () => {
         if (!stream || !videoElement.srcObject) {
             setStatus("Camera not active. Please allow access.", 'error');
@@ -34,22 +87,26 @@ document.addEventListener('DOMContentLoaded', () => {
         setStatus("Scanning your face... please wait.", 'processing');
         resultsGrid.innerHTML = ''; 
         resultsContainer.style.display = 'none';
+        loadMoreButton.style.display = 'none';
+        downloadAllLink.style.display = 'none';
         captureButton.disabled = true;
         captureButton.textContent = 'Scanning...';
 
 
-        canvasElement.width = videoElement.videoWidth;
-        canvasElement.height = videoElement.videoHeight;
+        // Downscale to the face detector's working size and upload raw JPEG bytes.
+        const scale = Math.min(1, SELFIE_MAX_SIDE / Math.max(videoElement.videoWidth, videoElement.videoHeight));
+        canvasElement.width = Math.round(videoElement.videoWidth * scale);
+        canvasElement.height = Math.round(videoElement.videoHeight * scale);
 
         const context = canvasElement.getContext('2d');
         context.drawImage(videoElement, 0, 0, canvasElement.width, canvasElement.height);
-        const imageDataURL = canvasElement.toDataURL('image/jpeg', 0.9);
+        const imageBlob = await new Promise(resolve => canvasElement.toBlob(resolve, 'image/jpeg', 0.9));
 
         try {
             const response = await fetch('/find_my_photos', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json', },
-                body: JSON.stringify({ image_data: imageDataURL }),
+                headers: { 'Content-Type': 'image/jpeg', },
+                body: imageBlob,
             });
 
             const data = await response.json(); 
@@ -64,27 +121,9 @@ document.addEventListener('DOMContentLoaded', () => {
             if (data.error) {
                  setStatus(`Error: ${data.error}`, 'error');
             } else if (data.matches && data.matches.length > 0) {
-                setStatus(`Found ${data.matches.length} photo(s) of you!`, 'success');
+                setStatus(`Found ${data.total} photo(s) of you!`, 'success');
                 resultsContainer.style.display = 'block'; 
-                data.matches.forEach(imagePath => {
-                    const photoCardDiv = document.createElement('div'); // Changed class name
-                    photoCardDiv.classList.add('photo-card'); // Changed class name
-
-                    const img = document.createElement('img');
-                    img.src = imagePath; 
-                    img.alt = "Matched photo";
-                    img.loading = "lazy"; // Lazy load images
-                    
-                    const downloadLink = document.createElement('a');
-                    const filename = imagePath.split('/').pop();
-                    downloadLink.href = `/download/${filename}`;
-                    downloadLink.textContent = `Download`;
-                    downloadLink.classList.add('download-link');
-                    downloadLink.setAttribute('download', filename); 
-                    photoCardDiv.appendChild(img);
-                    photoCardDiv.appendChild(downloadLink);
-                    resultsGrid.appendChild(photoCardDiv);
-                });
+                renderPhotos(data);
             } else {
                 setStatus(data.message || "No matches found for your face.", 'info');
             }